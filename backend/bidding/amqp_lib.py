@@ -5,9 +5,22 @@ References:
 https://pika.readthedocs.io/en/stable/_modules/pika/exceptions.html#ConnectionClosed
 """
 
+import queue
+import random
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import pika
 
+# Retry tiers in seconds, one delay queue <queue>.retry.<n>s per tier.
+# Keep in sync with retry_delays in rabbitmq_setup/amqp_setup.py.
+RETRY_DELAYS = (5, 30, 300)
+
+
+class PermanentError(Exception):
+    """Raised by a callback for a message that retrying cannot fix; it is
+    dead-lettered straight away instead of going through the delay queues."""
+
 
 def connect(hostname, port, exchange_name, exchange_type, max_retries=12, retry_interval=5,):
      retries = 0
@@ -61,6 +74,225 @@ def close(connection, channel):
      channel.close()
      connection.close()
 
+def backoff_delay(attempt, base_delay=0.5, max_delay=30):
+    # Exponential backoff with full jitter, so reconnecting clients spread out
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class ChannelManager:
+    """
+    Hands out one cached channel per thread and reconnects on failure.
+
+    pika connections are not thread-safe, so each thread gets its own
+    connection and channel, opened on first use and reused afterwards.
+    publish() does not check liveness first; if the channel turns out to
+    be dead it reconnects (with jittered exponential backoff) and retries once.
+    """
+
+    def __init__(self, hostname, port, exchange_name, exchange_type,
+                 confirms=False, max_retries=12, base_delay=0.5, max_delay=30):
+        self.hostname = hostname
+        self.port = port
+        self.exchange_name = exchange_name
+        self.exchange_type = exchange_type
+        self.confirms = confirms
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._local = threading.local()
+
+    def channel(self):
+        channel = getattr(self._local, "channel", None)
+        if channel is None or not channel.is_open:
+            self._open()
+        return self._local.channel
+
+    def _open(self):
+        self.close()
+        for attempt in range(self.max_retries):
+            try:
+                print(f"Connecting to AMQP broker {self.hostname}:{self.port}...")
+                connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(
+                        host=self.hostname,
+                        port=self.port,
+                        heartbeat=300,
+                        blocked_connection_timeout=300,
+                    )
+                )
+                channel = connection.channel()
+                channel.exchange_declare(
+                    exchange=self.exchange_name,
+                    exchange_type=self.exchange_type,
+                    passive=True,
+                )
+                if self.confirms:
+                    channel.confirm_delivery()
+                self._local.connection, self._local.channel = connection, channel
+                print("Connected")
+                return
+            except pika.exceptions.ChannelClosedByBroker as exception:
+                connection.close()
+                message = f"{self.exchange_type} exchange {self.exchange_name} not found."
+                raise Exception(message) from exception
+            except pika.exceptions.AMQPConnectionError as exception:
+                delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+                print(f"Failed to connect: {exception=}")
+                print(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+
+        raise Exception(f"Max {self.max_retries} retries exceeded...")
+
+    def publish(self, routing_key, body, properties=None, mandatory=False, exchange=None):
+        # exchange overrides the manager's exchange, e.g. "" to reply to a queue
+        for attempt in range(2):
+            try:
+                self.channel().basic_publish(
+                    exchange=self.exchange_name if exchange is None else exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=properties,
+                    mandatory=mandatory,
+                )
+                return
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError):
+                # The broker answered; reconnecting would not help
+                raise
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as exception:
+                print(f"Publish failed, reconnecting: {exception=}")
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection, self._local.channel = None, None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+
+class BatchPublisher:
+    """
+    Publishes from one background thread over a ChannelManager.
+
+    publish() can be called from any thread: it queues the message and
+    returns a Future that resolves once the message is out. The thread
+    drains up to batch_size queued messages at a time. With
+    transactional=True each batch is published in an AMQP transaction, so
+    one tx.commit round trip confirms the whole batch (a BlockingChannel in
+    confirm mode waits for every publish separately, so it cannot batch
+    confirms); otherwise messages are published one by one, unconfirmed.
+
+    A failed batch is retried after a jittered backoff. With max_attempts
+    set, the batch is dropped after that many failures and its futures
+    fail; without it, it is retried until it goes out.
+    """
+
+    def __init__(self, channel_manager, batch_size=100, max_queued=10000,
+                 transactional=False, max_attempts=None):
+        self.channel_manager = channel_manager
+        self.batch_size = batch_size
+        self.transactional = transactional
+        self.max_attempts = max_attempts
+        self.queue = queue.Queue(maxsize=max_queued)
+        self._sending = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, routing_key, body, block=True, timeout=None):
+        # Raises queue.Full if the message cannot be queued in time
+        self.start()
+        future = Future()
+        self.queue.put((routing_key, body, future), block=block, timeout=timeout)
+        return future
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout=5):
+        # Give queued messages a chance to go out, e.g. before the process exits
+        deadline = time.time() + timeout
+        while (self._sending or not self.queue.empty()) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def _send(self, batch):
+        if not self.transactional:
+            # Sent messages leave the batch, so a retry only resends the rest
+            while batch:
+                routing_key, body, future = batch[0]
+                self.channel_manager.publish(routing_key, body)
+                batch.pop(0)
+                future.set_result(None)
+            return
+
+        # Publish straight on the channel: a reconnect in the middle would lose
+        # the uncommitted part of the transaction, so any failure fails the
+        # whole batch and it is sent again on a fresh channel
+        channel = self.channel_manager.channel()
+        if not getattr(channel, "tx_selected", False):
+            channel.tx_select()
+            channel.tx_selected = True
+        try:
+            for routing_key, body, _ in batch:
+                channel.basic_publish(
+                    exchange=self.channel_manager.exchange_name, routing_key=routing_key, body=body
+                )
+            channel.tx_commit()
+        except Exception:
+            self.channel_manager.close()
+            raise
+        for _, _, future in batch:
+            future.set_result(None)
+        batch.clear()
+
+    def _loop(self):
+        pending = []
+        failures = 0
+        while True:
+            # Wait for the first message, servicing heartbeats while idle
+            if not pending:
+                self._sending = False
+                try:
+                    pending.append(self.queue.get(timeout=1))
+                except queue.Empty:
+                    try:
+                        self.channel_manager.channel().connection.process_data_events(time_limit=0)
+                    except Exception as exception:
+                        print(f"Publisher connection lost: {exception=}")
+                        self.channel_manager.close()
+                    continue
+                self._sending = True
+
+            # Drain whatever else is already waiting, up to one batch
+            while len(pending) < self.batch_size:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._send(pending)
+                failures = 0
+            except Exception as exception:
+                failures += 1
+                if self.max_attempts is not None and failures >= self.max_attempts:
+                    print(f"Dropping {len(pending)} messages after {failures} failed attempts: {exception=}")
+                    for _, _, future in pending:
+                        future.set_exception(exception)
+                    pending.clear()
+                    failures = 0
+                    continue
+                # Keep the unsent messages and try again after a backoff
+                print(f"Publish failed, retrying: {exception=}")
+                time.sleep(backoff_delay(failures - 1))
+
+
 def is_connection_open(connection):
     try:
         connection.process_data_events()
@@ -70,9 +302,90 @@ def is_connection_open(connection):
         return False
 
 
+def original_routing_key(method, properties):
+     # Messages coming back from a delay queue carry their original routing key
+     return (properties.headers or {}).get("x-original-routing-key", method.routing_key)
+
+
+def handle_message(connection, callback, channel, method, properties, body, retry_queue=None):
+     # Runs on a worker thread. The ack/nack is handed back to the connection's
+     # own thread, since pika channels must only be used from that thread.
+     headers = dict(properties.headers or {})
+     method.routing_key = original_routing_key(method, properties)
+     try:
+          callback(channel, method, properties, body)
+          settled, retryable = True, False
+     except PermanentError as exception:
+          print(f"Handler rejected {method.routing_key}: {exception=}")
+          settled, retryable = False, False
+     except Exception as exception:
+          print(f"Handler failed for {method.routing_key}: {exception=}")
+          settled, retryable = False, True
+
+     attempt = headers.get("x-retry-count", 0)
+     retry = retryable and retry_queue is not None and attempt < len(RETRY_DELAYS)
+
+     def settle():
+          if not channel.is_open:
+               return  # Connection was lost; the broker will redeliver
+          if settled:
+               channel.basic_ack(delivery_tag=method.delivery_tag)
+          elif retry:
+               # Park a copy in the next delay queue, then drop this delivery
+               headers["x-retry-count"] = attempt + 1
+               headers["x-original-routing-key"] = method.routing_key
+               delay_queue = f"{retry_queue}.retry.{RETRY_DELAYS[attempt]}s"
+               channel.basic_publish(
+                    exchange="",
+                    routing_key=delay_queue,
+                    body=body,
+                    properties=pika.BasicProperties(
+                         headers=headers,
+                         content_type=properties.content_type,
+                         correlation_id=properties.correlation_id,
+                         message_id=properties.message_id,
+                         reply_to=properties.reply_to,
+                         delivery_mode=2,
+                    ),
+               )
+               channel.basic_ack(delivery_tag=method.delivery_tag)
+               print(f"Retrying {method.routing_key} in {RETRY_DELAYS[attempt]}s")
+          else:
+               # Not requeued: the queue's dead-letter exchange moves it aside
+               channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+
+     try:
+          connection.add_callback_threadsafe(settle)
+     except pika.exceptions.AMQPError as exception:
+          print(f"Unable to settle message, it will be redelivered: {exception=}")
+
+
 def start_consuming(
-     hostname, port, exchange_name, exchange_type, queue_name, callback
+     hostname, port, exchange_name, exchange_type, queue_name, callback,
+     prefetch_count=None, workers=0, retry=False, executor_for=None,
 ):
+     """
+     Consume queue_name, calling callback(channel, method, properties, body).
+
+     With workers=0 messages are auto-acked and the callback runs on the pika
+     I/O thread. With workers>0 the callback runs on a pool of that many
+     threads, at most prefetch_count (default 2 x workers) messages are in
+     flight, and each message is acked only after its callback returns; a
+     callback that raises gets the message nacked. Callbacks running on the
+     pool must not use the channel they are given.
+
+     With retry=True (worker mode only) a failed message is instead moved to
+     the queue's delay queues, one tier of RETRY_DELAYS per attempt, and only
+     nacked to the dead-letter exchange once every tier has been tried.
+     A callback raising PermanentError skips the retries.
+
+     executor_for(routing_key), if given, picks the executor each message runs
+     on, e.g. one bounded pool per routing key so a burst on one key cannot
+     occupy the workers of the others. Returning None uses the shared pool.
+     """
+     retry_queue = queue_name if retry else None
+     executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+
      while True:
           try:
                 connection, channel = connect(
@@ -83,9 +396,25 @@ def start_consuming(
                 )
 
                 print(f"Consuming from queue: {queue_name}")
-                channel.basic_consume(
-                     queue=queue_name, on_message_callback=callback, auto_ack=True
-                )
+                if executor is not None:
+                     channel.basic_qos(prefetch_count=prefetch_count or workers * 2)
+
+                     def on_message(channel, method, properties, body, connection=connection):
+                          pool = executor
+                          if executor_for is not None:
+                               pool = executor_for(original_routing_key(method, properties)) or executor
+                          pool.submit(
+                               handle_message, connection, callback, channel, method, properties, body,
+                               retry_queue,
+                          )
+
+                     channel.basic_consume(
+                          queue=queue_name, on_message_callback=on_message, auto_ack=False
+                     )
+                else:
+                     channel.basic_consume(
+                          queue=queue_name, on_message_callback=callback, auto_ack=True
+                     )
                 channel.start_consuming()
 
           except pika.exceptions.ChannelClosedByBroker as exception:
@@ -99,6 +428,8 @@ def start_consuming(
 
           except KeyboardInterrupt:
                 close(connection, channel)
+                if executor is not None:
+                     executor.shutdown(wait=True)
                 break
 
           # Other types of exception are passed on to caller to handle.
@@ -1,9 +1,19 @@
-from flask import Flask, request, jsonify
-from pymongo import MongoClient
+from flask import Flask, Response, request, jsonify
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError
 import redis
 import os
 import json
 import pika
+import queue
+import threading
+import time
+import atexit
+import base64
+import signal
+import sys
 from flask_cors import CORS
 import amqp_lib
 
@@ -22,6 +32,48 @@ bids_collection = db["bids"]  # Collection Name
 # Redis Connection
 redis_client = redis.StrictRedis(host="redis-cache-service", port=6379, decode_responses=True)
 
+# Auction keys expire so idle auctions can be evicted; a miss reloads from MongoDB.
+# Auctions with no bids are cached briefly so unknown ids don't hit MongoDB every time.
+# This is only safe because a bid never runs against a missing key: the
+# accept-bid script refuses and place_bid reloads first, so an expired or
+# evicted key can never let a lower bid through.
+auction_key_ttl = int(os.getenv("AUCTION_KEY_TTL", str(7 * 24 * 3600)))  # seconds
+negative_cache_ttl = int(os.getenv("NEGATIVE_CACHE_TTL", "30"))  # seconds
+
+# Atomic "accept-if-higher" for a bid.
+# KEYS[1] = auction id (highest bid), KEYS[2] = highest bidder for that auction
+# KEYS[3] = (optional) write-behind stream the accepted bid is appended to
+# ARGV[1] = bid amount, ARGV[2] = bidder id, ARGV[3] = bid timestamp, ARGV[4] = key TTL
+# Accepted bids are also published as "auction_id:amount" on the bidding_updates
+# channel, which marketplace pushes out to watching clients.
+# Returns {1, new_highest[, stream_id]} if accepted, {0, current_highest} if rejected,
+# and {-1} if the auction is not cached: the caller must seed it from MongoDB and
+# retry, since accepting against a missing key could undercut the real highest bid.
+# Values are returned as strings because Redis truncates Lua numbers to integers.
+ACCEPT_BID_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return {-1}
+end
+if tonumber(ARGV[1]) <= tonumber(current) then
+    return {0, current}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[4])
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[4])
+redis.call('PUBLISH', 'bidding_updates', KEYS[1] .. ':' .. ARGV[1])
+if KEYS[3] then
+    local stream_id = redis.call('XADD', KEYS[3], '*',
+        'auctionId', KEYS[1], 'buyerId', ARGV[2], 'bidAmount', ARGV[1], 'timestamp', ARGV[3])
+    return {1, ARGV[1], stream_id}
+end
+return {1, ARGV[1]}
+"""
+accept_bid = redis_client.register_script(ACCEPT_BID_SCRIPT)
+
+
+def bidder_key(auction_id):
+    return f"{auction_id}:bidder"
+
 ###############################################################################################
 
 # RabbitMQ Config
@@ -33,41 +85,270 @@ queue_name = "auction"  # Queue for auction updates
 
 
 
+# Long-lived publisher: amqp_lib's BatchPublisher owns the AMQP connection
+# on one thread, and request threads hand it messages through its queue.
+# With BID_PUBLISH_CONFIRMS each batch is published in an AMQP transaction
+# and confirmed by one tx.commit round trip. Updates are retried until sent.
+publish_confirms = os.getenv("BID_PUBLISH_CONFIRMS", "false").lower() == "true"
+
+bid_publisher = amqp_lib.BatchPublisher(
+    amqp_lib.ChannelManager(
+        hostname=rabbit_host,
+        port=rabbit_port,
+        exchange_name=exchange_name,
+        exchange_type=exchange_type,
+    ),
+    transactional=publish_confirms,
+)
+
+# Give queued updates a chance to go out before the process exits
+atexit.register(bid_publisher.flush)
+
+
 # AMQP message for updating bid data
 def send_bid_update(listing_id, highest_bid):
+    routing_key = f"update.auction"  # Routing key for auction updates
+    message = json.dumps({'listing_id': listing_id, 'highest_bid': highest_bid})
     try:
-        # Establish connection to RabbitMQ using amqp_lib
-        connection, channel = amqp_lib.connect(
-            hostname=rabbit_host,
-            port=rabbit_port,
-            exchange_name=exchange_name,
-            exchange_type=exchange_type,
-        )
+        bid_publisher.publish(routing_key, message, block=False)
+    except queue.Full:
+        print(f"Bid update queue full, dropping: {message}")
+
+
+# Write-behind bid log: when enabled, a bid is acknowledged as soon as Redis
+# accepts it. The accepted bid is recorded in a Redis stream by the same
+# script call (for crash recovery) and queued in-process for a writer thread
+# that flushes to MongoDB with insert_many by size or time.
+write_behind = os.getenv("BID_WRITE_BEHIND", "false").lower() == "true"
+bid_stream = "bids:pending"
+bid_dead_stream = "bids:dead"  # Bids MongoDB refused for good, kept for inspection
+# A cache miss scans at most this many waiting bids; more means the writer is
+# far behind, and the miss fails instead of scanning the whole stream
+pending_scan_limit = 10000
+write_batch_size = 500
+write_interval = 0.2  # seconds
+write_queue = queue.Queue()
+writer_thread = None
+writer_lock = threading.Lock()
+
+
+def insert_bids(entries):
+    # entries: list of (stream_id, bid). streamId is unique in MongoDB, so
+    # replaying the stream after a crash never duplicates a bid.
+    docs = [dict(bid, streamId=stream_id) for stream_id, bid in entries]
+    parked = []
+    try:
+        bids_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if e.details.get("writeConcernErrors"):
+            raise
+        # A duplicate is a replay of a bid already written. Any other write
+        # error would fail the same way on every retry, so those bids are
+        # parked instead of holding up the writer.
+        parked = [(entries[err["index"]], err.get("errmsg", ""))
+                  for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+    if parked:
+        pipe = redis_client.pipeline()
+        for (stream_id, bid), error in parked:
+            fields = {key: "" if value is None else value for key, value in bid.items()}
+            pipe.xadd(bid_dead_stream, dict(fields, streamId=stream_id, error=error))
+        pipe.execute()
+        print(f"Parked {len(parked)} bids MongoDB refused in {bid_dead_stream}")
+    redis_client.xdel(bid_stream, *[stream_id for stream_id, _ in entries])
+
+
+def writer_loop():
+    while True:
+        try:
+            batch = [write_queue.get(timeout=1)]
+        except queue.Empty:
+            continue
+
+        deadline = time.time() + write_interval
+        while len(batch) < write_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            insert_bids(batch)
+        except Exception as e:
+            # The bids are still in the Redis stream; put them back and retry
+            print(f"Error writing {len(batch)} bids to MongoDB, retrying: {e}")
+            for entry in batch:
+                write_queue.put(entry)
+            time.sleep(1)
+
+
+def start_writer():
+    global writer_thread
+    with writer_lock:
+        if writer_thread is None or not writer_thread.is_alive():
+            writer_thread = threading.Thread(target=writer_loop, daemon=True)
+            writer_thread.start()
+
+
+def drain_writer():
+    # Flush everything still queued before the process exits
+    batch = []
+    while True:
+        try:
+            batch.append(write_queue.get_nowait())
+        except queue.Empty:
+            break
+    for i in range(0, len(batch), write_batch_size):
+        try:
+            insert_bids(batch[i:i + write_batch_size])
+        except Exception as e:
+            print(f"Error draining bids to MongoDB, left in {bid_stream}: {e}")
+    if batch:
+        print(f"Drained {len(batch)} queued bids to MongoDB")
+
+
+def recover_pending_bids():
+    # Replay bids that were accepted but never reached MongoDB
+    recovered = 0
+    last_id = "-"
+    while True:
+        entries = redis_client.xrange(bid_stream, min=last_id, count=write_batch_size)
+        if last_id != "-":
+            entries = [entry for entry in entries if entry[0] != last_id]
+        if not entries:
+            break
+        insert_bids([
+            (stream_id, {
+                "auctionId": fields["auctionId"],
+                "buyerId": fields["buyerId"],
+                "bidAmount": float(fields["bidAmount"]),
+                "timestamp": fields["timestamp"] or None,
+            })
+            for stream_id, fields in entries
+        ])
+        recovered += len(entries)
+        last_id = entries[-1][0]
+    if recovered:
+        print(f"Recovered {recovered} pending bids from {bid_stream}")
+
+
+def ensure_bid_indexes():
+    bids_collection.create_index("streamId", unique=True, sparse=True)
+    # Highest bid lookups and newest-first bid history
+    bids_collection.create_index([("auctionId", ASCENDING), ("bidAmount", DESCENDING)])
+    bids_collection.create_index(
+        [("auctionId", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]
+    )
 
-        # Publish bid update to RabbitMQ with a routing key
-        routing_key = f"update.auction"  # Routing key for auction updates
-        message = json.dumps({'listing_id': listing_id, 'highest_bid': highest_bid})
-        channel.basic_publish(exchange=exchange_name, routing_key=routing_key, body=message)
 
-        print(f"Sent bid update: {message} with routing key: {routing_key}")
-    except Exception as e:
-        print(f"Error sending bid update: {e}")
-    finally:
-        # Close the connection and channel using amqp_lib
-        amqp_lib.close(connection, channel)
+atexit.register(drain_writer)
+
+
+# docker stop sends SIGTERM, which would end the process without running the
+# atexit drains above; exiting through sys.exit runs them
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 
 # Prepopulate redis cache via MongoDB on startup
+# Runs in the background so the service can serve while it warms up. The
+# warm-up is only an optimisation: any auction missing from Redis, whether not
+# yet warmed, skipped or expired, is seeded from MongoDB on its next bid.
+warmup_days = int(os.getenv("BID_WARMUP_DAYS", "30"))
+warmup_chunk_size = 1000
+
+
 def populate_redis_cache():
     print("Populating Redis cache with highest bids from MongoDB...")
-    auctions = bids_collection.aggregate([
-        {"$group": {"_id": "$auctionId", "highestBid": {"$max": "$bidAmount"}}}
-    ])
-    for auction in auctions:
-        auction_id = auction["_id"]
-        highest_bid = auction["highestBid"]
-        redis_client.set(auction_id, highest_bid)
-        print(f"Cached auction {auction_id} with highest bid {highest_bid}")
+    started = time.time()
+    cached = 0
+    try:
+        # Bids are only accepted when higher, so the latest bids of an auction
+        # hold its maximum. Auctions without recent bids are skipped, and are
+        # loaded on demand if they are ever requested.
+        cutoff = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(started - warmup_days * 86400))
+        auctions = bids_collection.aggregate([
+            {"$match": {"timestamp": {"$gte": cutoff}}},
+            {"$group": {"_id": "$auctionId", "highestBid": {"$max": "$bidAmount"}}},
+        ], allowDiskUse=True, batchSize=warmup_chunk_size)
+
+        pipe = redis_client.pipeline(transaction=False)
+        for auction in auctions:
+            # Only seed keys that are missing so a warm-up never lowers a live bid
+            pipe.set(auction["_id"], auction["highestBid"], nx=True, ex=auction_key_ttl)
+            cached += 1
+            if cached % warmup_chunk_size == 0:
+                pipe.execute()
+                print(f"Cached {cached} auctions ({time.time() - started:.1f}s)")
+        pipe.execute()
+    except Exception as e:
+        print(f"Error populating Redis cache: {e}")
+    print(f"Populated Redis cache with {cached} auctions in {time.time() - started:.2f}s")
+
+
+def start_warmup():
+    threading.Thread(target=populate_redis_cache, daemon=True).start()
+
+
+# Misses currently being loaded, keyed by auction id. Concurrent misses for
+# the same auction wait on the first caller instead of querying MongoDB again.
+inflight_loads = {}
+inflight_lock = threading.Lock()
+
+
+def fetch_highest_bid(auction_id):
+    # With write-behind, accepted bids may still be waiting in the stream.
+    # The stream has no TTL, so eviction never drops it. It is read before
+    # MongoDB: a bid the writer moves across in between is then seen by the
+    # second read, whereas in the other order neither read would see it.
+    highest_bid = 0
+    if write_behind:
+        pending = redis_client.xrange(bid_stream, count=pending_scan_limit + 1)
+        if len(pending) > pending_scan_limit:
+            # Seeding from a partial scan could undercut a bid still waiting
+            raise RuntimeError(f"Over {pending_scan_limit} bids waiting in {bid_stream}")
+        for _, fields in pending:
+            if fields["auctionId"] == auction_id:
+                highest_bid = max(highest_bid, float(fields["bidAmount"]))
+
+    # Fetch the highest bid from MongoDB and cache it
+    highest_bid_entry = bids_collection.find_one(
+        {"auctionId": auction_id}, sort=[("bidAmount", -1)]
+    )
+    if highest_bid_entry:
+        highest_bid = max(highest_bid, highest_bid_entry["bidAmount"])
+
+    ttl = auction_key_ttl if highest_bid else negative_cache_ttl
+
+    # Store in Redis for future use, without clobbering a bid accepted meanwhile
+    redis_client.set(auction_id, highest_bid, nx=True, ex=ttl)
+    return highest_bid
+
+
+def load_highest_bid(auction_id):
+    with inflight_lock:
+        load = inflight_loads.get(auction_id)
+        leader = load is None
+        if leader:
+            load = inflight_loads[auction_id] = {"done": threading.Event()}
+
+    if not leader:
+        load["done"].wait()
+        if "error" in load:
+            raise load["error"]
+        return load["value"]
+
+    try:
+        load["value"] = fetch_highest_bid(auction_id)
+        return load["value"]
+    except Exception as e:
+        load["error"] = e
+        raise
+    finally:
+        with inflight_lock:
+            del inflight_loads[auction_id]
+        load["done"].set()
 
 ###############################################################################################
 
@@ -84,12 +365,33 @@ def place_bid():
     if not all([auction_id, bid_amount, bidder_id]):
         return jsonify({"error": "Missing required fields"}), 400
 
-    # Check the highest bid from Redis cache first
-    cached_highest = redis_client.get(auction_id)
-    current_highest = float(cached_highest) if cached_highest else 0
-
-    if bid_amount <= current_highest:
-        return jsonify({"error": "Bid must be higher than the current highest bid"}), 400
+    # Compare and set the highest bid in a single atomic Redis call, so two
+    # concurrent bids can never both pass the check. If the auction is not
+    # cached (never warmed, expired or evicted) the script refuses, and the
+    # key is seeded from MongoDB before trying again.
+    keys = [auction_id, bidder_key(auction_id)]
+    if write_behind:
+        keys.append(bid_stream)
+    for attempt in range(3):
+        accepted, *rest = accept_bid(
+            keys=keys, args=[bid_amount, bidder_id, timestamp or "", auction_key_ttl]
+        )
+        if int(accepted) != -1:
+            break
+        try:
+            load_highest_bid(auction_id)
+        except Exception as e:
+            print(f"Error loading highest bid for {auction_id}: {e}")
+            return jsonify({"error": "Unable to load the current highest bid, try again"}), 503
+    else:
+        return jsonify({"error": "Unable to load the current highest bid, try again"}), 503
+    current_highest, *stream_id = rest
+
+    if not int(accepted):
+        return jsonify({
+            "error": "Bid must be higher than the current highest bid",
+            "currentHighest": float(current_highest),
+        }), 400
 
     # Store the new bid in MongoDB
     new_bid = {
@@ -98,10 +400,12 @@ def place_bid():
         "bidAmount": bid_amount,
         "timestamp": timestamp,
     }
-    bids_collection.insert_one(new_bid)
+    if write_behind:
+        start_writer()
+        write_queue.put((stream_id[0], new_bid))
+    else:
+        bids_collection.insert_one(new_bid)
 
-    # Update Redis cache with the new highest bid
-    redis_client.set(auction_id, bid_amount)
     send_bid_update(auction_id, bid_amount)
 
 
@@ -118,24 +422,99 @@ def get_highest_bid(auction_id):
         return jsonify({"auctionId": auction_id, "highestBid": float(cached_highest)})
 
     # If not cached, fetch from MongoDB
-    highest_bid_entry = bids_collection.find_one(
-        {"auctionId": auction_id}, sort=[("bidAmount", -1)]
-    )
-    highest_bid = highest_bid_entry["bidAmount"] if highest_bid_entry else 0
-
-    # Store in Redis for future use
-    redis_client.set(auction_id, highest_bid)
+    highest_bid = load_highest_bid(auction_id)
 
     return jsonify({"auctionId": auction_id, "highestBid": highest_bid})
 
 
-# GET route to fetch all bids for an auction
+# Bid history paging
+# Bids are returned newest first and paged by a keyset cursor on
+# (timestamp, _id), backed by the (auctionId, timestamp, _id) index.
+# Without limit or cursor the whole history is returned, as before paging
+# existed; the listing page relies on that.
+bid_fields = ["auctionId", "buyerId", "bidAmount", "timestamp"]
+default_bid_page_size = 50
+max_bid_page_size = 500
+
+
+def encode_cursor(bid):
+    raw = json.dumps([bid.get("timestamp"), str(bid["_id"])])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    timestamp, bid_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    # The timestamp goes into the query as is, so anything else (e.g. an
+    # operator object) is rejected
+    if timestamp is not None and not isinstance(timestamp, str):
+        raise ValueError("Invalid cursor timestamp")
+    return timestamp, ObjectId(bid_id)
+
+
+def after_cursor(timestamp, bid_id):
+    # Everything that sorts after (timestamp, _id) in descending order.
+    # Missing timestamps sort last, so they always follow a real timestamp.
+    if timestamp is None:
+        return {"timestamp": None, "_id": {"$lt": bid_id}}
+    return {"$or": [
+        {"timestamp": {"$lt": timestamp}},
+        {"timestamp": timestamp, "_id": {"$lt": bid_id}},
+        {"timestamp": None},
+    ]}
+
+
+# GET route to fetch bids for an auction
+# Query params: limit, cursor, fields (comma separated), format=ndjson
 @app.route("/bids/<auction_id>", methods=["GET"])
 def get_bids(auction_id):
-    bids = list(bids_collection.find({"auctionId": auction_id}, {"_id": 0}))  # Hide MongoDB _id
-    return jsonify({"bids": bids})
+    stream = request.args.get("format") == "ndjson"
+    try:
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+        if limit is None and not stream and request.args.get("cursor"):
+            limit = default_bid_page_size
+        if limit is not None:
+            limit = max(1, min(limit, max_bid_page_size))
+
+        fields = bid_fields
+        if request.args.get("fields"):
+            fields = [f for f in request.args["fields"].split(",") if f in bid_fields]
+            if not fields:
+                return jsonify({"error": f"fields must be any of {bid_fields}"}), 400
+
+        query = {"auctionId": auction_id}
+        if request.args.get("cursor"):
+            query.update(after_cursor(*decode_cursor(request.args["cursor"])))
+    except (ValueError, TypeError, InvalidId):
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+
+    # _id and timestamp are always read because the cursor is built from them
+    projection = dict.fromkeys(set(fields) | {"timestamp"}, 1)
+    cursor = bids_collection.find(query, projection).sort([("timestamp", -1), ("_id", -1)])
+
+    if stream:
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        def generate():
+            for bid in cursor:
+                yield json.dumps({f: bid.get(f) for f in fields}) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    if limit is None:
+        return jsonify({"bids": [{f: bid.get(f) for f in fields} for bid in cursor], "nextCursor": None})
+
+    # Fetch one extra bid to know whether there is a next page
+    page = list(cursor.limit(limit + 1))
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    bids = [{f: bid.get(f) for f in fields} for bid in page[:limit]]
+    return jsonify({"bids": bids, "nextCursor": next_cursor})
 
 
 if __name__ == "__main__":
-    populate_redis_cache()
-    app.run(host="0.0.0.0", port=5002, debug=True)
+    ensure_bid_indexes()
+    recover_pending_bids()
+    start_warmup()
+    # No reloader: it serves from a child process that SIGTERM never reaches,
+    # so the queues would not be drained on docker stop
+    app.run(host="0.0.0.0", port=5002, debug=True, use_reloader=False)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 from dotenv import load_dotenv
+from collections import OrderedDict
 import json
 import os
+import threading
 import amqp_lib
 import requests
 
@@ -11,89 +13,108 @@ exchange_name = "grading_topic"
 exchange_type = "topic"
 queue_name = "delivery"
 
-connection = None
-channel = None
+# Consumer concurrency: messages are handled on a pool of worker threads and
+# acked once handled, with at most amqp_prefetch messages in flight
+amqp_workers = int(os.getenv("AMQP_WORKERS", "4"))
+amqp_prefetch = int(os.getenv("AMQP_PREFETCH", str(amqp_workers * 2)))
+
+# Publisher channel, cached and reconnected by amqp_lib
+publisher = amqp_lib.ChannelManager(
+    hostname=rabbit_host,
+    port=rabbit_port,
+    exchange_name=exchange_name,
+    exchange_type=exchange_type,
+)
 
 load_dotenv()
 delivery_api_key = os.getenv("DELIVERY_API_KEY")
 
-# RabbitMQ Connector
-def connectAMQP():
-    global connection, channel
-    print("  Connecting to AMQP broker...")
-    try:
-        connection, channel = amqp_lib.connect(
-            hostname=rabbit_host,
-            port=rabbit_port,
-            exchange_name=exchange_name,
-            exchange_type=exchange_type,
-        )
-    except Exception as exception:
-        print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
-        exit(1)
+# Orders already placed, gradingID -> deliveryID. A message retried because
+# its publish failed reuses the order instead of placing a second one.
+placed_orders = OrderedDict()
+placed_orders_max = 10000
+placed_orders_lock = threading.Lock()
+
+
+def place_order(result):
+    url = 'https://personal-slqn7xxm.outsystemscloud.com/ESDProject_VanNova_/rest/JohnnyAPI/order'
+    
+    # print(result)
+    
+    headers = {
+        "X-Api-Key": delivery_api_key,
+        "X-User-Id": result["userID"],
+        "Content-Type": "application/json"
+    }
+    
+    if '#' in result["address"]:
+        address_line1, address_line2 = result["address"].split("#")
+        address_line2 = "#" + address_line2
+    else:
+        address_line1 = result["address"]
+        address_line2 = ""
+        
+    data = {
+        "order": {
+            "orderDetails": str(result["gradingID"]),
+            "fromAddressLine1": address_line1,
+            "fromAddressLine2": address_line2,
+            "fromZipCode": str(result["postalCode"]),
+            "toAddressLine1": "90 Stamford Rd",
+            "toAddressLine2": "#03-01",
+            "toZipCode": "178903",
+            "userId": str(result["userID"])
+        }
+    }
+
+    response = requests.post(url, headers=headers, json=data)
+    response.raise_for_status()
+
+    print("Status Code:", response.status_code)
+    print("Response Body:", response.json())
+    
+    return response.json()["order"]["id"]
 
 def callback(channel, method, properties, body):
     # required signature for the callback; no return
     try:
         result = json.loads(body)
-        url = 'https://personal-slqn7xxm.outsystemscloud.com/ESDProject_VanNova_/rest/JohnnyAPI/order'
-        
-        # print(result)
-        
-        headers = {
-            "X-Api-Key": delivery_api_key,
-            "X-User-Id": result["userID"],
-            "Content-Type": "application/json"
-        }
-        
-        if '#' in result["address"]:
-            address_line1, address_line2 = result["address"].split("#")
-            address_line2 = "#" + address_line2
-        else:
-            address_line1 = result["address"]
-            address_line2 = ""
-            
-        data = {
-            "order": {
-                "orderDetails": str(result["gradingID"]),
-                "fromAddressLine1": address_line1,
-                "fromAddressLine2": address_line2,
-                "fromZipCode": str(result["postalCode"]),
-                "toAddressLine1": "90 Stamford Rd",
-                "toAddressLine2": "#03-01",
-                "toZipCode": "178903",
-                "userId": str(result["userID"])
-            }
-        }
-
-        response = requests.post(url, headers=headers, json=data)
+        gradingID = str(result["gradingID"])
+    except (ValueError, KeyError, TypeError) as e:
+        # Retrying cannot fix a malformed message
+        raise amqp_lib.PermanentError(f"Malformed delivery message: {e=}")
 
-        print("Status Code:", response.status_code)
-        print("Response Body:", response.json())
-        
-        if connection is None or not amqp_lib.is_connection_open(connection):
-            connectAMQP()
-        
+    try:
+        # The order is placed once; only the publish below is retried
+        with placed_orders_lock:
+            deliveryID = placed_orders.get(gradingID)
+        if deliveryID is None:
+            deliveryID = place_order(result)
+            with placed_orders_lock:
+                placed_orders[gradingID] = deliveryID
+                if len(placed_orders) > placed_orders_max:
+                    placed_orders.popitem(last=False)
         
-        result["deliveryID"] = response.json()["order"]["id"]
+        result["deliveryID"] = deliveryID
         result_json = json.dumps(result)
         
-        channel.basic_publish(
-            exchange=exchange_name, routing_key="delivery.update", body=result_json
-        )  
+        publisher.publish("delivery.update", result_json)
         
         # print(f"Delivery Message (JSON): {response}")
     except Exception as e:
-        print(f"Unable to parse JSON: {e=}")
+        print(f"Unable to process delivery: {e=}")
         print(f"Delivery Message (JSON): {body}")
-    print()
+        raise  # Let amqp_lib retry the message
+    finally:
+        print()
 
 
 if __name__ == "__main__":
     print(f"This is {os.path.basename(__file__)} - amqp consumer...")
     try:
         amqp_lib.start_consuming(
-            rabbit_host, rabbit_port, exchange_name, exchange_type, queue_name, callback
+            rabbit_host, rabbit_port, exchange_name, exchange_type, queue_name, callback,
+            prefetch_count=amqp_prefetch, workers=amqp_workers, retry=True,
         )
     except Exception as exception:
         print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
@@ -12,8 +12,18 @@ exchange_name = "grading_topic"
 exchange_type = "topic"
 queue_name = "external_grading"
 
-connection = None
-channel = None
+# Consumer concurrency: messages are handled on a pool of worker threads and
+# acked once handled, with at most amqp_prefetch messages in flight
+amqp_workers = int(os.getenv("AMQP_WORKERS", "4"))
+amqp_prefetch = int(os.getenv("AMQP_PREFETCH", str(amqp_workers * 2)))
+
+# Publisher channel, cached and reconnected by amqp_lib
+publisher = amqp_lib.ChannelManager(
+    hostname=rabbit_host,
+    port=rabbit_port,
+    exchange_name=exchange_name,
+    exchange_type=exchange_type,
+)
 
 # Supabase configuration
 load_dotenv()
@@ -21,33 +31,13 @@ supabase_url = os.getenv("SUPABASE_URL")
 supabase_key= os.getenv("SUPABASE_KEY")
 supabase = create_client(supabase_url, supabase_key)
 
-# RabbitMQ Connector
-def connectAMQP():
-    global connection, channel
-    print("  Connecting to AMQP broker...")
-    try:
-        connection, channel = amqp_lib.connect(
-            hostname=rabbit_host,
-            port=rabbit_port,
-            exchange_name=exchange_name,
-            exchange_type=exchange_type,
-        )
-    except Exception as exception:
-        print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
-        exit(1)
-
 def update_status(channel, method, properties, body):
     try:
         result = json.loads(body)
         result["status"] = "In Progress"
         result_json = json.dumps(result)
         
-        if connection is None or not amqp_lib.is_connection_open(connection):
-            connectAMQP()
-        
-        channel.basic_publish(
-            exchange=exchange_name, routing_key="status.update", body=result_json
-        )  
+        publisher.publish("status.update", result_json)
         
         # db
         response = supabase.table("external_grading").insert(result).execute()
@@ -58,9 +48,13 @@ def update_status(channel, method, properties, body):
             print("Error inserting data:", response.error)
         
         print(f"External Grader message (JSON): {result_json}")
+    except json.JSONDecodeError as e:
+        # Retrying cannot fix a malformed message
+        raise amqp_lib.PermanentError(f"Malformed JSON: {e}")
     except Exception as e:
         print(f"Unable to parse JSON: {e=}")
         print(f"External Grader message: {body}")
+        raise  # Let amqp_lib retry the message
     print()
     
 def get_result(channel, method, properties, body):
@@ -77,17 +71,16 @@ def get_result(channel, method, properties, body):
         
         result_json = json.dumps(response_data)
         
-        if connection is None or not amqp_lib.is_connection_open(connection):
-            connectAMQP()
-        
-        channel.basic_publish(
-            exchange=exchange_name, routing_key="result.update", body=result_json
-        )  
+        publisher.publish("result.update", result_json)
         
         print(f"External Grader message (JSON): {result_json}")
+    except json.JSONDecodeError as e:
+        # Retrying cannot fix a malformed message
+        raise amqp_lib.PermanentError(f"Malformed JSON: {e}")
     except Exception as e:
         print(f"Unable to parse JSON: {e=}")
         print(f"External Grader message: {body}")
+        raise  # Let amqp_lib retry the message
     print()    
 
 def callback(channel, method, properties, body):
@@ -106,7 +99,8 @@ if __name__ == "__main__":
     print(f"This is {os.path.basename(__file__)} - amqp consumer...")
     try:
         amqp_lib.start_consuming(
-            rabbit_host, rabbit_port, exchange_name, exchange_type, queue_name, callback
+            rabbit_host, rabbit_port, exchange_name, exchange_type, queue_name, callback,
+            prefetch_count=amqp_prefetch, workers=amqp_workers, retry=True,
         )
     except Exception as exception:
         print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
@@ -1,11 +1,17 @@
-from flask import jsonify
 from supabase import create_client
 from dotenv import load_dotenv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import hashlib
 import json
+import re
 import sys, os
+import threading
+import time
 import uuid  
 import amqp_lib
+import pika
 
 # Supabase configuration
 load_dotenv()
@@ -20,147 +26,212 @@ exchange_name = "grading_topic"
 exchange_type = "topic"
 queue_name = "grading"
 
-connection = None
-channel = None
+# Consumer concurrency: each route runs its messages on its own pool (see
+# Routing below); amqp_workers only sizes the pool for unrouted keys, which
+# are dead-lettered straight away. Messages are acked once handled.
+amqp_workers = int(os.getenv("AMQP_WORKERS", "2"))
 
-# RabbitMQ Connector
-def connectAMQP():
-    global connection, channel
-    print("  Connecting to AMQP broker...")
+# Publisher channel, cached and reconnected by amqp_lib
+publisher = amqp_lib.ChannelManager(
+    hostname=rabbit_host,
+    port=rabbit_port,
+    exchange_name=exchange_name,
+    exchange_type=exchange_type,
+)
+
+# Throttle on concurrent Supabase inserts, so the consumer can keep more
+# messages in flight than Supabase is asked to handle at once
+db_workers = int(os.getenv("GRADING_DB_WORKERS", "8"))
+db_slots = threading.BoundedSemaphore(db_workers)
+
+# gradingIDs are derived from the request, so a redelivered or retried
+# request maps to the same row instead of creating a new one
+grading_id_namespace = uuid.UUID("6f1c2f4e-5b7a-4f43-9d0e-2b8c1f6a7e90")
+
+# Batched publisher for grade_card: workers queue their messages and wait
+# for the futures before the delivery is acked. Each batch is committed in
+# one AMQP transaction, so a resolved future means the broker has the
+# message. A batch that keeps failing is dropped and its futures fail, which
+# sends the delivery through amqp_lib's retries.
+publish_timeout = float(os.getenv("GRADING_PUBLISH_TIMEOUT", "30"))
+batch_publisher = amqp_lib.BatchPublisher(publisher, transactional=True, max_attempts=3)
+
+
+def publish_async(routing_key, message):
+    return batch_publisher.publish(routing_key, message, timeout=publish_timeout)
+
+
+def parse_message(body):
+    # Retrying cannot fix a malformed message, so it is dead-lettered at once
     try:
-        connection, channel = amqp_lib.connect(
-            hostname=rabbit_host,
-            port=rabbit_port,
-            exchange_name=exchange_name,
-            exchange_type=exchange_type,
-        )
-    except Exception as exception:
-        print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
-        exit(1)
+        return json.loads(body)
+    except ValueError as e:
+        raise amqp_lib.PermanentError(f"Malformed JSON: {e}")
+
+
+def grading_id_for(properties, body, result):
+    # Prefer an explicit request id; fall back to the message body itself
+    request_key = result.get("requestID") or properties.message_id
+    if not request_key:
+        request_key = hashlib.sha256(body).hexdigest()
+    return str(uuid.uuid5(grading_id_namespace, str(request_key)))
+
+
+def insert_grading(data):
+    # Insert once per gradingID: a retry finds the row from its earlier attempt
+    with db_slots:
+        existing = supabase.table("grading").select("*").eq("gradingID", data["gradingID"]).execute()
+        if existing.data:
+            return existing.data[0]
+        return supabase.table("grading").insert(data).execute().data[0]
+
+
+# get_db results, cached per user for a short TTL so repeated polls from the
+# UI don't each hit Supabase. Writes for a user drop that user's entries.
+results_cache_ttl = float(os.getenv("GRADING_CACHE_TTL", "5"))
+results_cache_max_users = 10000
+results_page_size = 50
+results_max_page_size = 200
+results_cache = {}  # userID -> {(page, page_size): (expires_at, rows)}
+results_cache_lock = threading.Lock()
+
+
+def fetch_gradings(userID, page=None, page_size=None):
+    key = (page, page_size)
+    now = time.monotonic()
+    with results_cache_lock:
+        entry = results_cache.get(userID, {}).get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    query = supabase.table("grading").select("*").eq("userID", userID).order("created_at", desc=True)
+    if page is not None:
+        # One extra row tells whether there is a next page
+        start = page * page_size
+        query = query.range(start, start + page_size)
+    rows = query.execute().data
+
+    with results_cache_lock:
+        if len(results_cache) >= results_cache_max_users:
+            for user in [u for u, pages in results_cache.items() if all(e[0] <= now for e in pages.values())]:
+                del results_cache[user]
+        results_cache.setdefault(userID, {})[key] = (now + results_cache_ttl, rows)
+    return rows
+
+
+def invalidate_gradings(userID):
+    with results_cache_lock:
+        results_cache.pop(userID, None)
+
+
+def reply(properties, payload):
+    # RPC callers get the reply on their own queue, tagged with their
+    # correlation_id; others get the legacy broadcast on request.return
+    if not properties.reply_to:
+        publisher.publish("request.return", payload)
+        return
+    reply_to = properties.reply_to
+    # Web STOMP presents temp queues as /reply-queue/<amq.gen-...>
+    if reply_to.startswith("/reply-queue/"):
+        reply_to = reply_to[len("/reply-queue/"):]
+    publisher.publish(
+        reply_to,
+        payload,
+        properties=pika.BasicProperties(
+            correlation_id=properties.correlation_id,
+            content_type="application/json",
+        ),
+        exchange="",
+    )
+
 
 # Main function, comes from websocket/ui
 # grade_card, takes in bkey create.grading EXACT
 def grade_card(channel, method, properties, body):
-    result = json.loads(body)
-    try:
-        # print("\nReceived grading request:", result)
+    result = parse_message(body)
 
-        # Extract required fields
+    # Extract required fields
+    try:
         cardName = result["cardName"]
         cardID = result["cardID"]
         address = result["address"]
         postalCode = result["postalCode"]
         userID = result["userID"]
+    except KeyError as e:
+        raise amqp_lib.PermanentError(f"Missing field {e} in grading request")
 
-        if not all([cardID, address, postalCode]):
-            return jsonify({"code": 400, "message": "Missing required fields"}), 400
-
-        # Generate unique grading ID
-        gradingID = str(uuid.uuid4())
-        
-        # init data for db
-        data = {
-            "userID": userID,
-            "gradingID": gradingID,
-            "cardID": cardID,
-            "address": address,
-            "status": "Created",
-            "postalCode": postalCode, 
-            "result": "", 
-            "deliveryID": "",
-            "cardName": cardName,
-        }
-
-        # Upload to Supabase storage
-        response = supabase.table("grading").insert(data).execute()
-        
-        # if response.data:
-        #     print("Data from DB: " + json.dumps(response.data))
-        # else:
-        #     print("error: No record found")
-        
-        # Notify user
-        # print("Publishing notification request to RabbitMQ...")
-        helper_send_notify("Grading", response.data[0])
-        
-        # Send to Delivery
-        result = helper_send_delivery(data)
+    if not all([cardID, address, postalCode]):
+        raise amqp_lib.PermanentError(f"Missing required fields in grading request: {result}")
 
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        ex_str = f"{str(e)} at {exc_type}: {fname}: line {exc_tb.tb_lineno}"
-        print("Error:", ex_str)
+    # Same request, same grading ID
+    gradingID = grading_id_for(properties, body, result)
+    
+    # init data for db
+    data = {
+        "userID": userID,
+        "gradingID": gradingID,
+        "cardID": cardID,
+        "address": address,
+        "status": "Created",
+        "postalCode": postalCode, 
+        "result": "", 
+        "deliveryID": "",
+        "cardName": cardName,
+    }
 
-        return jsonify({"code": 500, "message": "Internal error", "exception": ex_str}), 500
+    # Both publishes need the row to exist (delivery later updates it by
+    # gradingID), so they follow the insert
+    row = insert_grading(data)
+    invalidate_gradings(userID)
 
-# Helper function
-# helper_send_delivery function send to deliver which calls external delivery
-def helper_send_delivery(data):
-    try:
-        data_json = json.dumps(data)
-        # print(data_json)
-        
-        # Connection to AMQP
-        if connection is None or not amqp_lib.is_connection_open(connection):
-            connectAMQP()
-        
-        # Publish to RabbitMQ
-        # print("Publishing grading request to RabbitMQ...")
-        channel.basic_publish(
-            exchange=exchange_name, routing_key="create.delivery", body=data_json
-        )
-        
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        ex_str = f"{str(e)} at {exc_type}: {fname}: line {exc_tb.tb_lineno}"
-        return {
-            "code": 500,
-            "message": "Internal error",
-            "exception": ex_str
-        }
+    # Notify user and send to Delivery in the publisher's next batch, then
+    # wait for both so the delivery is only acked once they are out.
+    # Any failure propagates and amqp_lib retries the message; the retry
+    # reuses the row, and delivery places one order per gradingID.
+    futures = [
+        publish_async("smth.notify", notification_payload("Grading", row)),
+        publish_async("create.delivery", json.dumps(data)),
+    ]
+    for future in futures:
+        future.result(timeout=publish_timeout)
 
 # Main function, comes from websocket/ui
 # grade_card, takes in bkey get.grading EXACT
 def get_db(channel, method, properties, body):
-    result = json.loads(body)
     try:
-        # print("\nReceived grading request:", result)
-        
+        result = json.loads(body)
+
         # Parse UUID from body
         userID = result["userID"]
         if not userID:
             raise ValueError("Missing 'userID' in request body.")
 
-        # Query Supabase table
-        # print(f"Querying Supabase for UserID: {userID}")
-        response = supabase.table("grading").select("*").eq("userID", userID).execute()
-
-        if response.data:
-            payload = json.dumps(response.data)
+        if properties.reply_to:
+            # RPC: one page per request, {"page": n, "pageSize": m} in the body
+            page = max(int(result.get("page", 0)), 0)
+            page_size = min(max(int(result.get("pageSize", results_page_size)), 1), results_max_page_size)
+            rows = fetch_gradings(userID, page, page_size)
+            payload = json.dumps({
+                "gradings": rows[:page_size],
+                "page": page,
+                "pageSize": page_size,
+                "nextPage": page + 1 if len(rows) > page_size else None,
+            })
         else:
-            payload = json.dumps({"error": "No record found"})
-
-        # Publish to RabbitMQ
-        # print("Publishing data to RabbitMQ...")
-        channel.basic_publish(
-            exchange=exchange_name,
-            routing_key="request.return",
-            body=payload
-        )
+            rows = fetch_gradings(userID)
+            if rows:
+                payload = json.dumps(rows)
+            else:
+                payload = json.dumps({"error": "No record found"})
     except Exception as e:
-        error_payload = json.dumps({"error": str(e)})
-        channel.basic_publish(
-            exchange=exchange_name,
-            routing_key="request.return",
-            body=error_payload
-        )
+        payload = json.dumps({"error": str(e)})
+
+    reply(properties, payload)
 
 # Main function, comes from websocket/ui
 # grade_card, takes in bkey get.grading EXACT
 def send_to_ext_grading(channel, method, properties, body):
-    result = json.loads(body)
+    result = parse_message(body)
     try:
         # print("\nReceived grading request:", result)
 
@@ -168,6 +239,7 @@ def send_to_ext_grading(channel, method, properties, body):
         response = supabase.table("grading").update({
                 "deliveryID": result["deliveryID"]
                 }).eq("gradingID", result["gradingID"]).execute()
+        invalidate_gradings(result.get("userID"))
         
         # if response.data:
         #     print("Data from DB: " + json.dumps(response.data))
@@ -179,146 +251,256 @@ def send_to_ext_grading(channel, method, properties, body):
         helper_send_notify("Delivery", result)
         
         # Send to External Grader
-        reponse = helper_send_grading(result)
+        helper_send_grading(result)
 
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         ex_str = f"{str(e)} at {exc_type}: {fname}: line {exc_tb.tb_lineno}"
         print("Error:", ex_str)
-
-        return jsonify({"code": 500, "message": "Internal error", "exception": ex_str}), 500
+        raise  # Let amqp_lib retry the message
 
 # Helper function
 # helper_send_grading function send to external grader and inform user
 def helper_send_grading(data):
-    try:
-        data_json = json.dumps(data)
-        # print(data_json)
-        
-        # Connection to AMQP
-        if connection is None or not amqp_lib.is_connection_open(connection):
-            connectAMQP()
-        
-        # Publish to RabbitMQ
-        # print("Publishing grading request to RabbitMQ...")
-        channel.basic_publish(
-            exchange=exchange_name, routing_key="create.externalGrading", body=data_json
-        )
-        
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        ex_str = f"{str(e)} at {exc_type}: {fname}: line {exc_tb.tb_lineno}"
-        return {
-            "code": 500,
-            "message": "Internal error",
-            "exception": ex_str
-        }
+    data_json = json.dumps(data)
+    # print(data_json)
+    
+    # Publish to RabbitMQ
+    # print("Publishing grading request to RabbitMQ...")
+    publisher.publish("create.externalGrading", data_json)
 
 # Main function, comes from external grading ms
-# update_grading, takes in bkey .update
-def update_grading(channel, method, propertites, body, routing_key):
+# update_grading, writes the given fields of an .update message
+def update_grading(body, fields):
+    result = parse_message(body)
     try:
-        result = json.loads(body)
         # print(f"Grader message (JSON): {result}")
         
-        if "status" in routing_key:
-            response = supabase.table("grading").update({
-                "status": result["status"]
-                }).eq("gradingID", result["gradingID"]).execute()
-        elif "result" in routing_key:
-            response = supabase.table("grading").update({
-                "status": result["status"],
-                "result": result["result"]
-                }).eq("gradingID", result["gradingID"]).execute()
+        response = supabase.table("grading").update({
+            field: result[field] for field in fields
+            }).eq("gradingID", result["gradingID"]).execute()
         
+        invalidate_gradings(result.get("userID"))
         # Notify user
         helper_send_notify("Grading", result)
         
     except Exception as e:
-        error_payload = json.dumps({"error": str(e)})
-        channel.basic_publish(
-            exchange=exchange_name,
-            routing_key=".return",
-            body=error_payload
-        )
+        print(f"Unable to update grading: {e=}")
+        raise  # Let amqp_lib retry the message
+
+# update_status, takes in bkey status.update EXACT
+def update_status(channel, method, properties, body):
+    update_grading(body, ["status"])
+
+# update_result, takes in bkey result.update EXACT
+def update_result(channel, method, properties, body):
+    update_grading(body, ["status", "result"])
+
+
+# Helper function
+# notification_payload, builds the message for the notification ms
+def notification_payload(service, data):
+    shippingID = ""
+
+    if service == "Delivery":
+        shippingID = data["deliveryID"]
+
+    result = {
+        "Service": service,
+        "Text": "",
+        "Timestamp": datetime.now().isoformat(),
+        "Data": {
+            "UserID": "",
+            "CardID": data["cardID"],
+            "Status": data["status"],
+            "GradingID": data["gradingID"],
+            "ShippingID": shippingID,
+            "AuctionID": "",
+            "Price": "",
+            "PhoneNumber": "+6581276017",
+            "CardName" : data["cardName"],
+            "RefundID" : ""
+        }
+    }
+
+    # print("notification:")
+    # print(result)
 
+    return json.dumps(result)
 
 # Helper function
 # helper_send_notify, sends rkey .notify to notification ms
 def helper_send_notify(service, data):
-    try:
-        shippingID = ""
-    
-        if service == "Delivery":
-            shippingID = data["deliveryID"]
-
-        result = {
-            "Service": service,
-            "Text": "",
-            "Timestamp": datetime.now().isoformat(),
-            "Data": {
-                "UserID": "",
-                "CardID": data["cardID"],
-                "Status": data["status"],
-                "GradingID": data["gradingID"],
-                "ShippingID": shippingID,
-                "AuctionID": "",
-                "Price": "",
-                "PhoneNumber": "+6581276017",
-                "CardName" : data["cardName"],
-                "RefundID" : ""
+    publisher.publish("smth.notify", notification_payload(service, data))
+
+###############################################################################################
+
+# Routing: each routing key (or precompiled pattern) maps to a Route with its
+# own concurrency limit, timeout and latency histogram. A route's limit is the
+# size of its own thread pool, which amqp_lib picks when the message arrives,
+# so a burst on one route queues in that route's pool and never occupies the
+# threads of the others. Queued messages are not failures and are not retried.
+#
+# A handler that overruns its timeout is only counted and logged, not retried:
+# a Python thread cannot be stopped, so a retry would run it twice, e.g. a
+# duplicate grade_card insert.
+
+# Upper bounds of the latency histogram buckets, in seconds
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+metrics_interval = float(os.getenv("GRADING_METRICS_INTERVAL", "60"))
+
+
+class Route:
+    def __init__(self, name, handler, concurrency, timeout):
+        self.name = name
+        self.handler = handler
+        # Overridable per route, e.g. GRADING_GRADE_CARD_CONCURRENCY=8
+        self.concurrency = int(os.getenv(f"GRADING_{name.upper()}_CONCURRENCY", concurrency))
+        self.timeout = float(os.getenv(f"GRADING_{name.upper()}_TIMEOUT", timeout))
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.buckets = [0] * (len(latency_buckets) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+
+    def __call__(self, channel, method, properties, body):
+        started = time.monotonic()
+        try:
+            self.handler(channel, method, properties, body)
+        except Exception:
+            self.observe(started, failed=True)
+            raise
+        elapsed = self.observe(started)
+        if elapsed > self.timeout:
+            print(f"{self.name} overran its {self.timeout}s timeout: {elapsed:.1f}s")
+
+    def observe(self, started, failed=False):
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.buckets[bisect.bisect_left(latency_buckets, elapsed)] += 1
+            self.count += 1
+            self.total_seconds += elapsed
+            self.errors += failed
+            self.timeouts += elapsed > self.timeout
+        return elapsed
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, hits in zip(latency_buckets + (float("inf"),), self.buckets):
+            seen += hits
+            if hits and seen >= rank:
+                return bound
+        return 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "route": self.name,
+                "count": self.count,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "mean_ms": round(1000 * self.total_seconds / self.count, 1) if self.count else 0,
+                "p50_s": self.percentile(0.5),
+                "p95_s": self.percentile(0.95),
+                "p99_s": self.percentile(0.99),
+                "buckets": dict(zip([str(b) for b in latency_buckets] + ["+Inf"], self.buckets)),
             }
-        }
-        
-        # print("notification:")
-        # print(result)
-    
-        # Connection to AMQP
-        if connection is None or not amqp_lib.is_connection_open(connection):
-            connectAMQP()
-        
-        result_str = json.dumps(result)
-            
-        channel.basic_publish(
-            exchange=exchange_name, routing_key="smth.notify", body=result_str
-        )
-    except Exception as e:
-        error_payload = json.dumps({"error": str(e)})
-        channel.basic_publish(
-            exchange=exchange_name,
-            routing_key=".return",
-            body=error_payload
-        )
+
+
+routes = {}          # exact routing key -> Route
+pattern_routes = []  # (compiled pattern, Route), tried in order
+unknown_keys = {}    # routing key -> count of messages nobody handles
+unknown_keys_lock = threading.Lock()
+unknown_keys_max = 1000
+
+
+def route(key, handler, concurrency=2, timeout=30):
+    # key is an exact routing key, or a compiled pattern matched in full
+    entry = Route(handler.__name__, handler, concurrency, timeout)
+    if isinstance(key, re.Pattern):
+        pattern_routes.append((key, entry))
+    else:
+        routes[key] = entry
+
+
+def find_route(routing_key):
+    entry = routes.get(routing_key)
+    if entry is None:
+        for pattern, candidate in pattern_routes:
+            if pattern.fullmatch(routing_key):
+                return candidate
+    return entry
+
+
+route("create.grading", grade_card, concurrency=8, timeout=60)
+route("get.grading", get_db, concurrency=4, timeout=10)
+route("delivery.update", send_to_ext_grading, concurrency=4, timeout=30)
+route("status.update", update_status, concurrency=2, timeout=30)
+route("result.update", update_result, concurrency=2, timeout=30)
+
+# Enough prefetched messages to keep every route pool busy with one queued
+# behind each worker. The window is shared, so a long burst on one route can
+# still hold most of it; the other routes then wait in the broker, not here.
+amqp_prefetch = int(os.getenv(
+    "AMQP_PREFETCH",
+    str(2 * sum(entry.concurrency for entry in list(routes.values()) + [e for _, e in pattern_routes])),
+))
+
+
+def route_executor(routing_key):
+    entry = find_route(routing_key)
+    return entry.executor if entry is not None else None
+
+
+def report_metrics():
+    while True:
+        time.sleep(metrics_interval)
+        for entry in list(routes.values()) + [entry for _, entry in pattern_routes]:
+            snapshot = entry.snapshot()
+            if snapshot["count"]:
+                print(f"Route metrics: {json.dumps(snapshot)}")
+        with unknown_keys_lock:
+            unrouted = dict(unknown_keys)
+        if unrouted:
+            print(f"Unrouted keys: {json.dumps(unrouted)}")
+
+
+threading.Thread(target=report_metrics, daemon=True).start()
+
 
 # Route to Main functions base on rKey
 def callback(channel, method, properties, body):
-    try:
-        # Get the routing key
-        routing_key = method.routing_key  
-
-        # Log or print the routing key and message
-        print(f"Received message with routing key: {routing_key}")
-        if routing_key == "create.grading":
-            grade_card(channel, method, properties, body)
-        elif routing_key == "get.grading":
-            get_db(channel, method, properties, body)
-        elif routing_key == "delivery.update":
-            send_to_ext_grading(channel, method, properties, body)
-        elif ".update" in routing_key:
-            update_grading(channel, method, properties, body, routing_key)
+    routing_key = method.routing_key
+    print(f"Received message with routing key: {routing_key}")
 
+    entry = find_route(routing_key)
+    if entry is None:
+        with unknown_keys_lock:
+            if routing_key in unknown_keys or len(unknown_keys) < unknown_keys_max:
+                unknown_keys[routing_key] = unknown_keys.get(routing_key, 0) + 1
+        # Dead-lettered to grading.dead, where it can be inspected
+        raise amqp_lib.PermanentError(f"No route for routing key {routing_key}")
+
+    try:
+        entry(channel, method, properties, body)
     except Exception as e:
-        print(f"Unable to parse JSON: {e=}")
+        print(f"Error handling {routing_key} in {entry.name}: {e=}")
         print(f"Grader message: {body}")
+        raise  # Let amqp_lib retry the message
 
 # Run at start
 if __name__ == "__main__":
     print(f"This is {os.path.basename(__file__)} - amqp consumer...")
     try:
         amqp_lib.start_consuming(
-            rabbit_host, rabbit_port, exchange_name, exchange_type, queue_name, callback
+            rabbit_host, rabbit_port, exchange_name, exchange_type, queue_name, callback,
+            prefetch_count=amqp_prefetch, workers=amqp_workers, retry=True,
+            executor_for=route_executor,
         )
     except Exception as exception:
         print(f"  Unable to connect to RabbitMQ.\n     {exception=}\n")
@@ -1,7 +1,16 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 from supabase import create_client
+from collections import OrderedDict, namedtuple
+import bisect
+import brotli
+import gzip
+import hashlib
+import json
 import os
+import re
+import threading
+import time
 
 app = Flask(__name__)
 CORS(app)
@@ -11,20 +20,407 @@ supabase_url = os.getenv("SUPABASE_URL")
 supabase_key= os.getenv("SUPABASE_KEY")
 supabase = create_client(supabase_url, supabase_key)
 
+##############################################################################################################
+
+# Card catalog cache
+# The card table is nearly static, so the whole catalog is kept in memory and
+# refreshed in the background before CATALOG_TTL seconds pass. Rendered responses are cached per query
+# in a small LRU, pre-compressed, with a strong ETag over the JSON body.
+# Cards are not kept as dicts: each one is a compact record of the fields used
+# for filtering and search plus its pre-serialized JSON, which responses join.
+CATALOG_TTL = 300  # seconds
+RESPONSE_CACHE_SIZE = 256
+MAX_PAGE_SIZE = 100
+MIN_COMPRESS_BYTES = 1024
+MAX_BATCH_IDS = 1000
+CATALOG_PAGE = 1000  # PostgREST caps a single select at max-rows
+
+CardRecord = namedtuple("CardRecord", ["id", "name", "set_id", "rarity", "supertype", "types", "body"])
+
+catalog = {"cards": [], "index": {}, "loaded_at": 0.0, "version": 0}
+catalog_lock = threading.Lock()
+
+
+def card_record(card):
+    types = card.get('types')
+    return CardRecord(
+        id=str(card['id']),
+        name=card.get('name'),
+        set_id=card.get('set_id'),
+        rarity=card.get('rarity'),
+        supertype=card.get('supertype'),
+        types=tuple(types) if isinstance(types, list) else types,
+        body=json.dumps(card, separators=(',', ':')).encode(),
+    )
+
+
+def join_cards(records):
+    return b"[" + b",".join(record.body for record in records) + b"]"
+
+
+def fetch_cards():
+    """Every row of the card table in id order, a page at a time."""
+    rows = []
+    while True:
+        # Keyset paging on id; only an empty page ends the load, since the
+        # server's cap may be lower than CATALOG_PAGE
+        query = supabase.table('cards').select('*')
+        if rows:
+            query = query.gt('id', rows[-1]['id'])
+        page = query.order('id').limit(CATALOG_PAGE).execute().data
+        if not page:
+            return rows
+        rows.extend(page)
+
+
+def reload_catalog():
+    """Load the card table and rebuild the id index. Call with catalog_lock held."""
+    cards = [card_record(card) for card in fetch_cards()]
+    index = {record.id: record for record in cards}
+
+    # Only re-index the cards that were added, changed or removed
+    previous = catalog["index"]
+    for card_id in previous.keys() - index.keys():
+        search_index.remove(card_id)
+    for record in cards:
+        if previous.get(record.id) != record:
+            search_index.add(record)
+    catalog.update(cards=cards, index=index, loaded_at=time.time(),
+                   version=catalog["version"] + 1)
+
+
+def get_catalog():
+    """Return the cached card records in id order, reloading them from Supabase when stale."""
+    if time.time() - catalog["loaded_at"] >= CATALOG_TTL:
+        with catalog_lock:
+            # Another request may have reloaded it while we waited
+            if time.time() - catalog["loaded_at"] >= CATALOG_TTL:
+                reload_catalog()
+    return catalog["cards"], catalog["version"]
+
+
+def get_index():
+    get_catalog()
+    return catalog["index"]
+
+
+def refresh_catalog_forever():
+    # Refresh ahead of the TTL so requests never wait on a reload
+    while True:
+        try:
+            with catalog_lock:
+                reload_catalog()
+        except Exception as e:
+            print(f"Error refreshing card catalog: {e}")
+        time.sleep(CATALOG_TTL * 0.8)
+
+
+class ResponseCache:
+    """Thread-safe LRU of rendered responses that expire after a TTL."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry["created_at"] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        entry["created_at"] = time.time()
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, CATALOG_TTL)
+
+
+def render(body, headers=None):
+    """Keep the identity, gzip and brotli forms of a JSON body with their ETag."""
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    entry = {"etag": etag, "headers": headers or {}, "bodies": {"identity": body}}
+    if len(body) >= MIN_COMPRESS_BYTES:
+        entry["bodies"]["br"] = brotli.compress(body, quality=5)
+        entry["bodies"]["gzip"] = gzip.compress(body, compresslevel=6)
+    return entry
+
+
+def send(entry):
+    """Answer from a rendered entry, honoring If-None-Match and Accept-Encoding."""
+    accepted = request.accept_encodings
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in entry["bodies"] and accepted[candidate]:
+            encoding = candidate
+            break
+
+    # Each encoding is a different representation, so it gets its own strong ETag
+    etag = entry["etag"] if encoding == "identity" else f'{entry["etag"]}-{encoding}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry["bodies"][encoding], mimetype="application/json")
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"  # Always revalidate, but allow 304s
+    for name, value in entry["headers"].items():
+        response.headers[name] = value
+    return response
+
+##############################################################################################################
+
+# Card search
+# A local inverted index over the searchable card fields, kept in step with the
+# catalog. Query terms match whole tokens, token prefixes, or (for terms of 4+
+# characters) tokens one or two edits away; results are ranked by match quality
+# with name matches weighted highest.
+SEARCH_FIELDS = {"name": 3, "set_id": 1, "types": 1, "supertype": 1, "rarity": 1}
+FACET_FIELDS = ("rarity", "set_id", "types")
+EXACT_SCORE, PREFIX_SCORE, FUZZY_SCORE = 3, 2, 1
+
+
+def tokenize(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [token for item in value for token in tokenize(item)]
+    return re.findall(r"\w+", str(value).lower())
+
+
+def within_edits(a, b, max_edits):
+    """Levenshtein distance check that gives up once max_edits is exceeded."""
+    if abs(len(a) - len(b)) > max_edits:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_edits:
+            return False
+        previous = current
+    return previous[-1] <= max_edits
+
+
+def has_value(card, field, value):
+    values = getattr(card, field)
+    return value in values if isinstance(values, tuple) else value == values
+
+
+class SearchIndex:
+    """Inverted index of token -> {card id: field weight}."""
+
+    def __init__(self):
+        self.postings = {}
+        self.cards = {}
+        self.vocabulary = []
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def add(self, card):
+        with self.lock:
+            self.remove(card.id)
+            self.cards[card.id] = card
+            for field, weight in SEARCH_FIELDS.items():
+                for token in tokenize(getattr(card, field)):
+                    postings = self.postings.setdefault(token, {})
+                    postings[card.id] = max(postings.get(card.id, 0), weight)
+            self.dirty = True
+
+    def remove(self, card_id):
+        with self.lock:
+            card = self.cards.pop(card_id, None)
+            if card is None:
+                return
+            for field in SEARCH_FIELDS:
+                for token in tokenize(getattr(card, field)):
+                    postings = self.postings.get(token)
+                    if postings is not None:
+                        postings.pop(card_id, None)
+                        if not postings:
+                            del self.postings[token]
+            self.dirty = True
+
+    def expand(self, term):
+        """Vocabulary tokens matching a query term, with their match score."""
+        if self.dirty:
+            self.vocabulary = sorted(self.postings)
+            self.dirty = False
+        matches = {}
+        start = bisect.bisect_left(self.vocabulary, term)
+        for token in self.vocabulary[start:]:
+            if not token.startswith(term):
+                break
+            matches[token] = EXACT_SCORE if token == term else PREFIX_SCORE
+        if not matches and len(term) >= 4:
+            max_edits = 1 if len(term) < 8 else 2
+            for token in self.vocabulary:
+                if within_edits(term, token, max_edits):
+                    matches[token] = FUZZY_SCORE
+        return matches
+
+    def search(self, query, filters):
+        with self.lock:
+            terms = tokenize(query)
+            if terms:
+                # Every term must match; a card scores its best match per term
+                scores = None
+                for term in terms:
+                    term_scores = {}
+                    for token, match_score in self.expand(term).items():
+                        for card_id, weight in self.postings[token].items():
+                            term_scores[card_id] = max(term_scores.get(card_id, 0), match_score * weight)
+                    if scores is None:
+                        scores = term_scores
+                    else:
+                        scores = {card_id: score + term_scores[card_id]
+                                  for card_id, score in scores.items() if card_id in term_scores}
+            else:
+                scores = dict.fromkeys(self.cards, 0)
+
+            hits = [self.cards[card_id] for card_id in scores]
+
+        # Facet counts are over the query matches, before facet filters apply
+        facets = {field: {} for field in FACET_FIELDS}
+        for card in hits:
+            for field in FACET_FIELDS:
+                values = getattr(card, field)
+                for value in values if isinstance(values, tuple) else [values]:
+                    if value is not None:
+                        facets[field][value] = facets[field].get(value, 0) + 1
+
+        for field, value in filters.items():
+            hits = [card for card in hits if has_value(card, field, value)]
+
+        hits.sort(key=lambda card: (-scores[card.id], card.name or ''))
+        return hits, facets
+
+
+search_index = SearchIndex()
+threading.Thread(target=refresh_catalog_forever, daemon=True).start()
+
+##############################################################################################################
+
 @app.route('/')
 def home():
     return "Card Collection API"
 
-# Get all cards from inventory
+# Get cards from inventory
+# Query params:
+#   q, set_id, rarity   filter by name substring, set and rarity
+#   page, limit         return one page; the total is sent in X-Total-Count
+# Without page/limit the whole (filtered) catalog is returned.
 @app.route('/inventory', methods=['GET'])
 def get_cards():
-    response = supabase.table('cards').select('*').execute()
-    return jsonify(response.data)
+    q = request.args.get('q', '').strip().lower()
+    set_id = request.args.get('set_id')
+    rarity = request.args.get('rarity')
+    try:
+        page = int(request.args['page']) if 'page' in request.args else None
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({"error": "page and limit must be integers"}), 400
+    if page is not None or limit is not None:
+        page = max(page or 1, 1)
+        limit = max(1, min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE))
+
+    cards, version = get_catalog()
+    key = (version, q, set_id, rarity, page, limit)
+    entry = response_cache.get(key)
+    if entry is None:
+        matches = [
+            card for card in cards
+            if (not q or q in (card.name or '').lower())
+            and (not set_id or card.set_id == set_id)
+            and (not rarity or card.rarity == rarity)
+        ]
+        if page is not None:
+            start = (page - 1) * limit
+            entry = render(join_cards(matches[start:start + limit]), {"X-Total-Count": str(len(matches))})
+        else:
+            entry = render(join_cards(matches))
+        response_cache.set(key, entry)
+
+    return send(entry)
+
+# Search cards
+# Query params:
+#   q                       search terms (prefix and typo tolerant)
+#   rarity, set_id, types   facet filters
+#   page, limit             paging, limit defaults to 20
+@app.route('/inventory/search', methods=['GET'])
+def search_cards():
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        limit = max(1, min(int(request.args.get('limit', 20)), MAX_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "page and limit must be integers"}), 400
+    filters = {field: request.args[field] for field in FACET_FIELDS if request.args.get(field)}
+
+    get_catalog()
+    hits, facets = search_index.search(request.args.get('q', ''), filters)
+
+    start = (page - 1) * limit
+    return jsonify({
+        "results": [json.loads(card.body) for card in hits[start:start + limit]],
+        "total": len(hits),
+        "page": page,
+        "limit": limit,
+        "facets": facets,
+    })
+
+# Get several cards at once
+# Body: {"ids": [...], "include_missing": false}
+# Returns the cards in request order (duplicates removed). With include_missing,
+# returns {"cards": [...], "not_found": [...]} instead.
+@app.route('/inventory/batch', methods=['POST'])
+def get_cards_batch():
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not ids or not isinstance(ids, list):
+        return jsonify({"error": "A list of ids is required"}), 400
+    if len(ids) > MAX_BATCH_IDS:
+        return jsonify({"error": f"At most {MAX_BATCH_IDS} ids per request"}), 400
+
+    index = get_index()
+    ids = list(dict.fromkeys(str(card_id) for card_id in ids))
+    found = [index[card_id] for card_id in ids if card_id in index]
+    not_found = [card_id for card_id in ids if card_id not in index]
+
+    cards = join_cards(found)
+    if data.get('include_missing'):
+        body = b'{"cards":' + cards + b',"not_found":' + json.dumps(not_found).encode() + b"}"
+        return Response(body, mimetype="application/json")
+
+    response = Response(cards, mimetype="application/json")
+    response.headers["X-Not-Found-Count"] = str(len(not_found))
+    return response
 
 # Get a specific card by card_id
 @app.route('/inventory/<card_id>', methods=['GET'])
 def get_card(card_id):
+    card = get_index().get(card_id)
+    if card is not None:
+        return Response(card.body, mimetype="application/json")
+
+    # Not in the catalog yet, it may have been added since the last refresh
     response = supabase.table('cards').select('*').eq('id', card_id).execute()
+    if not response.data:
+        return jsonify({"error": "Card not found"}), 404
     return jsonify(response.data[0])
 
 if __name__ == "__main__":
@@ -1,13 +1,20 @@
-from flask import Flask, request, jsonify, json
+from flask import Flask, Response, request, jsonify, json
 from supabase import create_client
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PIL import Image
 from flask_cors import CORS
 import uuid
 import os
+import base64
+import hashlib
+import io
+import tempfile
 import redis
-import asyncio
+import threading
 import pika
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import time
 import logging
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -39,36 +46,125 @@ supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # Connect to Redis
 redis_client = redis.StrictRedis(host="redis-cache-service", port=6379, decode_responses=True)
-pubsub = redis_client.pubsub()
-pubsub.subscribe("bidding_updates")
 
-async def listen_to_redis():
-    """Listen for messages on Redis Pub/Sub."""
+# Clients watching an auction over SSE, keyed by auction id. Each watcher holds
+# only the latest bid and an event to wake it, so a slow client never queues
+# up stale prices: it just gets the newest one when it catches up.
+watchers = {}
+watchers_lock = threading.Lock()
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def add_watcher(auction_id):
+    watcher = {"event": threading.Event(), "latest": None}
+    with watchers_lock:
+        watchers.setdefault(auction_id, {})[id(watcher)] = watcher
+    return watcher
+
+
+def remove_watcher(auction_id, watcher):
+    with watchers_lock:
+        auction_watchers = watchers.get(auction_id, {})
+        auction_watchers.pop(id(watcher), None)
+        if not auction_watchers:
+            watchers.pop(auction_id, None)
+
+
+def broadcast_to_clients(auction_id, highest_bid):
+    """Hand the latest bid to every client watching this auction."""
+    with watchers_lock:
+        targets = list(watchers.get(auction_id, {}).values())
+    for watcher in targets:
+        watcher["latest"] = highest_bid
+        watcher["event"].set()
+
+
+def listen_to_redis():
+    """Listen for messages on Redis Pub/Sub, blocking until one arrives."""
     while True:
         try:
-            message = pubsub.get_message()
-            if message and message["type"] == "message":
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe("bidding_updates")
+            for message in pubsub.listen():
                 auction_id, highest_bid = message["data"].split(":")
                 print(f"New bid received: Auction ID {auction_id}, Highest Bid {highest_bid}")
 
+                # Push the update to SSE clients first, it is the latency-sensitive path
+                broadcast_to_clients(auction_id, highest_bid)
+
                 # Update Supabase with the new highest bid
                 update_highest_bid_in_supabase(auction_id, highest_bid)
-
-                # Broadcast update via WebSockets
-                await broadcast_to_clients(auction_id, highest_bid)
         except Exception as e:
             print(f"Error in Redis listener: {e}")
-        await asyncio.sleep(0.01)  # Avoid busy waiting
+            time.sleep(1)
+
+
+# Coalesced highest_bid writes. The listener only records the latest bid per
+# auction; a flusher thread writes whatever is pending every BID_FLUSH_INTERVAL_MS,
+# so a bidding war costs one Supabase update per auction per interval.
+BID_FLUSH_INTERVAL_MS = int(os.getenv("BID_FLUSH_INTERVAL_MS", "500"))
+MAX_PENDING_BIDS = 10000
+pending_bids = {}
+pending_bids_lock = threading.Lock()
+bid_write_metrics = {"received": 0, "merged": 0, "dropped": 0, "written": 0, "errors": 0}
 
 
 def update_highest_bid_in_supabase(auction_id, highest_bid):
-    """Update the highest bid in Supabase."""
-    try:
-        supabase.table('marketplace').update({
-            'highest_bid': highest_bid
-        }).eq('auction_id', auction_id).execute()
-    except Exception as e:
-        print(f"Error updating Supabase: {e}")
+    """Queue the highest bid for the next Supabase flush."""
+    with pending_bids_lock:
+        bid_write_metrics["received"] += 1
+        if auction_id in pending_bids:
+            bid_write_metrics["merged"] += 1
+            pending_bids[auction_id] = max(float(highest_bid), pending_bids[auction_id])
+        elif len(pending_bids) >= MAX_PENDING_BIDS:
+            bid_write_metrics["dropped"] += 1
+            print(f"Pending bid queue full, dropping update for auction {auction_id}")
+        else:
+            pending_bids[auction_id] = float(highest_bid)
+
+
+def flush_highest_bids():
+    """Write every pending highest bid to Supabase."""
+    global pending_bids
+    with pending_bids_lock:
+        batch, pending_bids = pending_bids, {}
+
+    failed = {}
+    for auction_id, highest_bid in batch.items():
+        try:
+            # Never lower a highest bid another writer has already recorded
+            supabase.table('marketplace').update({
+                'highest_bid': highest_bid,
+                'updated_at': now_iso(),
+            }).eq('id', auction_id).or_(
+                f'highest_bid.is.null,highest_bid.lt.{highest_bid}'
+            ).execute()
+            bid_write_metrics["written"] += 1
+        except Exception as e:
+            bid_write_metrics["errors"] += 1
+            failed[auction_id] = highest_bid
+            print(f"Error updating Supabase, retrying next flush: {e}")
+
+    # Put failed writes back so the next flush retries them, merged with any
+    # higher bid that arrived meanwhile. They bypass MAX_PENDING_BIDS: they
+    # were already admitted, and dropping one could leave a final bid unsaved.
+    if failed:
+        with pending_bids_lock:
+            for auction_id, highest_bid in failed.items():
+                pending_bids[auction_id] = max(highest_bid, pending_bids.get(auction_id, highest_bid))
+
+    if batch:
+        invalidate_listings(*batch, pages=False)
+
+
+def flush_highest_bids_forever():
+    while True:
+        time.sleep(BID_FLUSH_INTERVAL_MS / 1000)
+        flush_highest_bids()
+
+
+threading.Thread(target=flush_highest_bids_forever, daemon=True).start()
+threading.Thread(target=listen_to_redis, daemon=True).start()
 
 #################################################################################################################
 
@@ -79,77 +175,171 @@ RABBITMQ_EXCHANGE = "grading_topic"
 RABBITMQ_ROUTING_KEY = "*.notify"
 
 
-# Function to publish a message to RabbitMQ
-def publish_to_rabbitmq(message):
+# Auction-close notifications
+# Both the close timer and the sweep below notify through notify_closed_auctions.
+# Each auction is first claimed in Redis with SET NX, so it is published by
+# exactly one replica and one path; the claim becomes "sent" once the broker
+# has the message, and a claim that is never confirmed expires and is retried.
+# Each batch is published in one AMQP transaction, a single round trip.
+# The sweep pages through closed auctions by (auction_end_date, id) and keeps
+# a high-water mark in Redis, advanced only past rows that are fully sent, so
+# a run after downtime (or a failed publish) catches up from there.
+NOTIFY_HWM_KEY = "auction_notify:hwm"
+NOTIFY_GRACE_SECONDS = 120  # Re-check this far behind the mark for late closes
+NOTIFY_PAGE = 1000  # PostgREST caps a single select at max-rows
+NOTIFY_CLAIM_SECONDS = 300  # An unconfirmed claim is retried after this long
+NOTIFIED_TTL = 7 * 24 * 3600  # seconds
+notify_metrics = {"runs": 0, "last_run_seconds": None, "last_run_rows": 0,
+                  "last_run_published": 0, "last_run_skipped": 0, "errors": 0}
+
+
+def notified_key(auction_id):
+    return f"auction_notify:sent:{auction_id}"
+
+
+def auction_closed_message(row):
+    return {
+        "Service": "Bidding",
+        "Text": "",
+        "Timestamp": row["auction_end_date"],
+        "Data": {
+            "UserID": row["highest_bidder_id"],  # Replace with dynamic user ID if needed
+            "CardID": row["card_id"],
+            "Status": row["status"],
+            "AuctionID": row["id"],
+            "Price": row["highest_bid"],
+            "PhoneNumber": "+6581276017",
+        },
+    }
+
+
+# Publish every row in one transaction: all of them reach the broker, or the
+# commit raises and none do
+def publish_to_rabbitmq(rows):
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT)
+    )
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
         channel = connection.channel()
 
         # Declare the exchange
         channel.exchange_declare(exchange=RABBITMQ_EXCHANGE, exchange_type="topic", durable=True)
 
-        # Publish the message
-        channel.basic_publish(
-            exchange=RABBITMQ_EXCHANGE,
-            routing_key=RABBITMQ_ROUTING_KEY,
-            body=json.dumps(message),
-            properties=pika.BasicProperties(content_type="application/json"),
-        )
-
-        print(f"Published message: {message}")
-    except Exception as e:
-        print(f"Error publishing message to RabbitMQ: {e}")
+        channel.tx_select()
+        for row in rows:
+            channel.basic_publish(
+                exchange=RABBITMQ_EXCHANGE,
+                routing_key=RABBITMQ_ROUTING_KEY,
+                body=json.dumps(auction_closed_message(row)),
+                properties=pika.BasicProperties(content_type="application/json", delivery_mode=2),
+            )
+        channel.tx_commit()
+        logging.debug(f"Published {len(rows)} auction notifications")
     finally:
-        if "connection" in locals() and connection.is_open:
+        if connection.is_open:
             connection.close()
 
+
+def notify_closed_auctions(rows):
+    """Claim and publish the rows nobody has notified yet; returns how many were published."""
+    pipe = redis_client.pipeline(transaction=False)
+    for row in rows:
+        pipe.set(notified_key(row["id"]), "claimed", nx=True, ex=NOTIFY_CLAIM_SECONDS)
+    claimed = [row for row, won in zip(rows, pipe.execute()) if won]
+    if not claimed:
+        return 0
+
+    keys = [notified_key(row["id"]) for row in claimed]
+    try:
+        publish_to_rabbitmq(claimed)
+    except Exception:
+        # Release the claims so the next sweep retries them
+        redis_client.delete(*keys)
+        raise
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.set(key, "sent", ex=NOTIFIED_TTL)
+    pipe.execute()
+    return len(claimed)
+
+
 # Function to query Supabase and publish messages
 def check_and_publish():
+    started = time.time()
     try:
         with app.app_context():  # Ensure Flask context is available if needed
             logging.warning("Scheduler triggered: check_and_publish started.")
 
-            # Calculate the time window
-            now = datetime.now()
-            time_window_start = now - timedelta(seconds=120)
+            # Calculate the time window from the last successful run
+            now = datetime.now(timezone.utc)
+            hwm = redis_client.get(NOTIFY_HWM_KEY)
+            last_run = datetime.fromisoformat(hwm) if hwm else now
+            time_window_start = last_run - timedelta(seconds=NOTIFY_GRACE_SECONDS)
             logging.warning(f"Time window start: {time_window_start}, Now: {now}")
 
-            # Query Supabase for relevant entries
-            query_result = (
-                supabase.table("marketplace")
-                .select("id, card_id, status, highest_bid, auction_end_date, highest_bidder_id")
-                .eq("status", "closed")
-                .gte("auction_end_date", time_window_start.isoformat())
-                .lte("auction_end_date", now.isoformat())
-                .execute()
-            )
-
-            logging.info(f"Query result: {query_result.data}")
-            rows = query_result.data
-
-            # Publish a message for each entry
-            for row in rows:
-                message = {
-                    "Service": "Bidding",
-                    "Text": "",
-                    "Timestamp": row["auction_end_date"],
-                    "Data": {
-                        "UserID": row["highest_bidder_id"],  # Replace with dynamic user ID if needed
-                        "CardID": row["card_id"],
-                        "Status": row["status"],
-                        "AuctionID": row["id"],
-                        "Price": row["highest_bid"],
-                        "PhoneNumber": "+6581276017",
-                    },
-                }
-                logging.debug(f"Publishing message: {message}")
-                publish_to_rabbitmq(message)
+            # The mark follows the rows in order and stops at the first one that
+            # is not sent yet: failed, or claimed by a run still in flight
+            mark = now.isoformat()
+            mark_blocked = False
+            total = published = skipped = 0
+            last = None
+            while True:
+                # Keyset paging on (auction_end_date, id), so every row in the
+                # window is seen however many auctions closed at once
+                query = (
+                    supabase.table("marketplace")
+                    .select("id, card_id, status, highest_bid, auction_end_date, highest_bidder_id")
+                    .eq("status", "closed")
+                    .gte("auction_end_date", time_window_start.isoformat())
+                    .lte("auction_end_date", now.isoformat())
+                )
+                if last is not None:
+                    query = query.or_(after_listing_cursor("auction_end_date", False, *last))
+                rows = query.order("auction_end_date").order("id").limit(NOTIFY_PAGE).execute().data
+                if not rows:
+                    break
+                total += len(rows)
+                last = (rows[-1]["auction_end_date"], rows[-1]["id"])
+
+                states = redis_client.mget([notified_key(row["id"]) for row in rows])
+                pending = [row for row, state in zip(rows, states) if not state]
+                skipped += len(rows) - len(pending)
+                try:
+                    published += notify_closed_auctions(pending) if pending else 0
+                except Exception as e:
+                    notify_metrics["errors"] += 1
+                    logging.error(f"Error publishing {len(pending)} auction notifications: {e}")
+
+                if not mark_blocked:
+                    states = redis_client.mget([notified_key(row["id"]) for row in rows])
+                    for row, state in zip(rows, states):
+                        if state is None or state == "claimed":
+                            mark, mark_blocked = row["auction_end_date"], True
+                            break
+
+                if len(rows) < NOTIFY_PAGE:
+                    break
+
+            redis_client.set(NOTIFY_HWM_KEY, mark.replace("Z", "+00:00"))
+            notify_metrics.update(last_run_rows=total, last_run_published=published,
+                                  last_run_skipped=skipped)
 
     except Exception as e:
+        notify_metrics["errors"] += 1
         logging.error(f"Error querying database or publishing messages: {e}")
+    finally:
+        duration = time.time() - started
+        notify_metrics["runs"] += 1
+        notify_metrics["last_run_seconds"] = round(duration, 3)
+        logging.info(f"check_and_publish finished in {duration:.2f}s: {notify_metrics}")
+        if duration > 50:
+            logging.warning("check_and_publish is close to overrunning its one-minute schedule")
 
 
 # Add a cron job to run every minute using APScheduler
+# Auctions are closed on time by the timer below; this sweep picks up listings
+# closed by other paths (e.g. a completed payment) and anything the timer missed.
 scheduler.add_job(
     func=check_and_publish,
     trigger=CronTrigger.from_crontab("* * * * *"),  # Cron expression for every minute
@@ -159,6 +349,284 @@ scheduler.add_job(
 logging.info("Scheduled job: send_auction_notifications")
 
 
+# Auction close timer
+# Auction end times live in a Redis sorted set scored by epoch seconds. A
+# worker thread pops due auctions with a Lua script (ZRANGEBYSCORE + ZREM in
+# one atomic call), so each auction is claimed by exactly one replica, then
+# closes it and sends its notification straight away.
+AUCTION_CLOSE_KEY = "auctions:closing"
+AUCTION_CLOSE_BATCH = 100
+AUCTION_CLOSE_RETRY_SECONDS = 5
+AUCTION_CLOSE_MAX_WAIT = 1.0  # seconds between polls when nothing is due sooner
+AUCTION_SCHEDULE_PAGE = 1000  # PostgREST caps a single select at max-rows
+
+POP_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+pop_due_auctions = redis_client.register_script(POP_DUE_SCRIPT)
+auction_timer_wakeup = threading.Event()
+
+
+def parse_timestamp(value):
+    # Supabase returns ISO 8601; Python 3.9 does not accept a trailing Z
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def schedule_auction_close(listing_id, auction_end_date):
+    try:
+        redis_client.zadd(AUCTION_CLOSE_KEY, {listing_id: parse_timestamp(auction_end_date)})
+        auction_timer_wakeup.set()
+    except (redis.RedisError, ValueError) as e:
+        logging.error(f"Error scheduling close of auction {listing_id}: {e}")
+
+
+def unschedule_auction_close(listing_id):
+    try:
+        redis_client.zrem(AUCTION_CLOSE_KEY, listing_id)
+    except redis.RedisError as e:
+        logging.error(f"Error unscheduling close of auction {listing_id}: {e}")
+
+
+def bidder_key(auction_id):
+    # Same keys as the bidding service: <auction id> holds the highest bid
+    return f"{auction_id}:bidder"
+
+
+def redis_highest_bids(listing_ids):
+    """(highest bid, bidder) from Redis for each auction that has a bid."""
+    values = redis_client.mget([key for listing_id in listing_ids for key in (listing_id, bidder_key(listing_id))])
+    return {
+        listing_id: (float(highest_bid), bidder)
+        for listing_id, highest_bid, bidder in zip(listing_ids, values[::2], values[1::2])
+        if highest_bid is not None and bidder
+    }
+
+
+def close_auctions(listing_ids):
+    # Supabase's highest_bid trails Redis by up to a bid flush, so the final
+    # bid is read from Redis and written with the close. Auctions without a bid
+    # are closed in one update; the others need their own values, so each gets
+    # an update of its own, run in parallel. Only auctions still active are
+    # closed, and the rows returned are notified in one batch.
+    closed_at = now_iso()
+    bids = redis_highest_bids(listing_ids)
+
+    def close_with_bid(listing_id):
+        highest_bid, bidder = bids[listing_id]
+        return (
+            supabase.table("marketplace")
+            .update({"status": "closed", "updated_at": closed_at,
+                     "highest_bid": highest_bid, "highest_bidder_id": bidder})
+            .eq("id", listing_id)
+            .eq("status", "active")
+            .execute()
+            .data
+        )
+
+    closed = []
+    without_bid = [listing_id for listing_id in listing_ids if listing_id not in bids]
+    if without_bid:
+        closed += (
+            supabase.table("marketplace")
+            .update({"status": "closed", "updated_at": closed_at})
+            .in_("id", without_bid)
+            .eq("status", "active")
+            .execute()
+            .data
+        )
+    for rows in batch_executor.map(close_with_bid, [listing_id for listing_id in listing_ids if listing_id in bids]):
+        closed += rows
+    invalidate_listings(*listing_ids)
+    if not closed:
+        return
+    try:
+        notify_closed_auctions(closed)
+    except Exception as e:
+        # Already closed, so the check_and_publish sweep notifies them later
+        logging.error(f"Error notifying {len(closed)} closed auctions: {e}")
+        return
+    logging.info(f"Closed {len(closed)} auctions")
+
+
+def run_auction_timer():
+    while True:
+        try:
+            due = pop_due_auctions(keys=[AUCTION_CLOSE_KEY], args=[time.time(), AUCTION_CLOSE_BATCH])
+            if due:
+                try:
+                    close_auctions(due)
+                except Exception as e:
+                    logging.error(f"Error closing {len(due)} auctions, retrying: {e}")
+                    retry_at = time.time() + AUCTION_CLOSE_RETRY_SECONDS
+                    redis_client.zadd(AUCTION_CLOSE_KEY, {listing_id: retry_at for listing_id in due})
+                if len(due) == AUCTION_CLOSE_BATCH:
+                    continue  # More may be due already
+
+            # Sleep until the next auction is due, or until a new one is scheduled
+            wait = AUCTION_CLOSE_MAX_WAIT
+            upcoming = redis_client.zrange(AUCTION_CLOSE_KEY, 0, 0, withscores=True)
+            if upcoming:
+                wait = min(max(upcoming[0][1] - time.time(), 0), AUCTION_CLOSE_MAX_WAIT)
+            auction_timer_wakeup.wait(wait)
+            auction_timer_wakeup.clear()
+        except Exception as e:
+            logging.error(f"Error in auction timer: {e}")
+            time.sleep(AUCTION_CLOSE_MAX_WAIT)
+
+
+def load_auction_schedule():
+    # Schedule active auctions that were listed before the timer existed
+    try:
+        scheduled = 0
+        last_id = None
+        while True:
+            # Keyset paging on id: auctions closing meanwhile cannot shift
+            # later pages, as they would with offsets
+            query = (
+                supabase.table("marketplace")
+                .select("id, auction_end_date")
+                .eq("type", "auction")
+                .eq("status", "active")
+                .not_.is_("auction_end_date", "null")
+            )
+            if last_id is not None:
+                query = query.gt("id", last_id)
+            rows = query.order("id").limit(AUCTION_SCHEDULE_PAGE).execute().data
+            # Stop on an empty page rather than a short one, in case the
+            # server's max-rows is below AUCTION_SCHEDULE_PAGE
+            if not rows:
+                break
+            redis_client.zadd(AUCTION_CLOSE_KEY, {
+                row["id"]: parse_timestamp(row["auction_end_date"]) for row in rows
+            })
+            auction_timer_wakeup.set()
+            scheduled += len(rows)
+            last_id = rows[-1]["id"]
+        logging.info(f"Scheduled {scheduled} active auctions")
+    except Exception as e:
+        logging.error(f"Error loading auction schedule: {e}")
+
+
+threading.Thread(target=load_auction_schedule, daemon=True).start()
+threading.Thread(target=run_auction_timer, daemon=True).start()
+
+
+#################################################################################################################
+
+# Read-through listing cache
+# Single listings are cached under listing:<id> and dropped on every write to
+# that listing. Each write also bumps the listing's version; a reader notes the
+# version before querying and only caches its row if the version is unchanged,
+# so a read that raced a write cannot put the old row back.
+# List pages are cached under a generation number that writes bump, so all
+# pages are invalidated at once without scanning keys. A page read before a
+# bump is stored under the old generation, where nobody looks for it.
+# highest_bid flushes only drop the single listings: bumping the generation
+# every flush would empty the page cache throughout bidding, and live prices
+# reach clients over SSE anyway. Pages may show a bid up to LISTINGS_CACHE_TTL old.
+LISTING_CACHE_TTL = 300  # seconds
+LISTINGS_CACHE_TTL = 60  # seconds
+LISTINGS_VERSION_KEY = "listings:version"
+
+# Cache a listing only if its version is still the one read before the query
+# KEYS[1] = listing:<id>, KEYS[2] = listing:<id>:version
+# ARGV[1] = version read earlier ("" if none), ARGV[2] = listing JSON, ARGV[3] = TTL
+SET_LISTING_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+set_listing_if_current = redis_client.register_script(SET_LISTING_SCRIPT)
+
+
+def listing_cache_key(listing_id):
+    return f"listing:{listing_id}"
+
+
+def listing_version_key(listing_id):
+    return f"listing:{listing_id}:version"
+
+
+def listing_version(listing_id):
+    """Version to pass to cache_listing, or None if it cannot be read."""
+    try:
+        return redis_client.get(listing_version_key(listing_id)) or ""
+    except redis.RedisError as e:
+        print(f"Error reading listing version: {e}")
+        return None
+
+
+def cache_listing(listing, version):
+    if version is None:
+        return
+    try:
+        set_listing_if_current(
+            keys=[listing_cache_key(listing['id']), listing_version_key(listing['id'])],
+            args=[version, json.dumps(listing), LISTING_CACHE_TTL],
+        )
+    except redis.RedisError as e:
+        print(f"Error writing listing cache: {e}")
+
+
+def listings_cache_key(signature):
+    version = redis_client.get(LISTINGS_VERSION_KEY) or "0"
+    digest = hashlib.sha1(json.dumps(signature).encode()).hexdigest()
+    return f"listings:{version}:{digest}"
+
+
+def cache_get(key):
+    try:
+        cached = redis_client.get(key)
+        return json.loads(cached) if cached is not None else None
+    except redis.RedisError as e:
+        print(f"Error reading cache {key}: {e}")
+        return None
+
+
+def cache_set(key, value, ttl):
+    try:
+        redis_client.set(key, json.dumps(value), ex=ttl)
+    except redis.RedisError as e:
+        print(f"Error writing cache {key}: {e}")
+
+
+def invalidate_listings(*listing_ids, pages=True):
+    """Drop cached copies of the given listings and, unless pages=False, every cached list page."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for listing_id in listing_ids:
+            # Outlives any read in flight, which only has to see that it changed
+            pipe.incr(listing_version_key(listing_id))
+            pipe.expire(listing_version_key(listing_id), LISTING_CACHE_TTL)
+        if listing_ids:
+            pipe.delete(*[listing_cache_key(listing_id) for listing_id in listing_ids])
+        if pages:
+            pipe.incr(LISTINGS_VERSION_KEY)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Error invalidating listing cache: {e}")
+
+
+def conditional_response(response, etag=None):
+    """Tag the response with an ETag and answer 304 if the client already has it.
+
+    etag defaults to a hash of the body; a single listing passes its
+    updated_at so the same value works in If-Match on PUT/DELETE.
+    """
+    response.headers["Cache-Control"] = "no-cache"  # Always revalidate, but allow 304s
+    if etag:
+        response.set_etag(etag)
+    else:
+        response.add_etag()
+    return response.make_conditional(request)
+
+
 #################################################################################################################
 
 @app.route('/')
@@ -170,6 +638,170 @@ def home():
 def health_check():
     return jsonify({"status": "Marketplace API is running!"}), 200
 
+# Internal counters for the background workers
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    with pending_bids_lock:
+        bid_writes = dict(bid_write_metrics, pending=len(pending_bids))
+    return jsonify({"bid_writes": bid_writes, "auction_notifications": notify_metrics}), 200
+
+
+# Stream highest bid updates for a listing as Server-Sent Events
+@app.route('/api/marketplace/listings/<listing_id>/stream', methods=['GET'])
+def stream_listing_bids(listing_id):
+    watcher = add_watcher(listing_id)
+    current = redis_client.get(listing_id)
+
+    def generate():
+        try:
+            if current is not None:
+                yield f"data: {json.dumps({'listing_id': listing_id, 'highest_bid': float(current)})}\n\n"
+            while True:
+                if watcher["event"].wait(timeout=SSE_KEEPALIVE_SECONDS):
+                    # Clear before reading so a bid arriving now wakes us again
+                    watcher["event"].clear()
+                    highest_bid = float(watcher["latest"])
+                    yield f"data: {json.dumps({'listing_id': listing_id, 'highest_bid': highest_bid})}\n\n"
+                else:
+                    yield ": keep-alive\n\n"
+        finally:
+            remove_watcher(listing_id, watcher)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Don't let the gateway buffer events
+    return response
+
+
+# Image uploads
+# Listing images are spooled to a temporary file and streamed to Supabase
+# storage on a thread pool, so the upload overlaps the row insert. WebP
+# thumbnails are rendered in a process pool once the listing exists and stored
+# next to the original as listings/thumbs/<filename>.webp. Listing responses
+# carry its URL as thumbnail_url; until it is rendered that URL 404s, so
+# clients fall back to image_url.
+IMAGE_BUCKET = "marketplace-images"
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+IMAGE_CHUNK_BYTES = 64 * 1024
+THUMBNAIL_SIZE = (320, 320)
+
+# Reject oversized requests before the body is read
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_BYTES + 1024 * 1024
+
+# Originals are uploaded on upload_executor, which create_listing waits on.
+# Thumbnail work never touches it: the render runs in the process pool and its
+# completion hands the upload to thumbnail_executor, so no thread blocks
+# waiting for a render.
+upload_executor = ThreadPoolExecutor(max_workers=8)
+variant_executor = ProcessPoolExecutor(max_workers=2)
+thumbnail_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def spool_image(image_file):
+    """Copy the uploaded image to a temporary file in chunks and return its path."""
+    size = 0
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        try:
+            while True:
+                chunk = image_file.stream.read(IMAGE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise RequestEntityTooLarge()
+                tmp.write(chunk)
+        except Exception:
+            os.remove(tmp.name)
+            raise
+    return tmp.name
+
+
+def thumbnail_path(file_path):
+    filename = file_path.rsplit('/', 1)[-1]
+    return f"listings/thumbs/{filename.rsplit('.', 1)[0]}.webp"
+
+
+def with_thumbnail_url(listing):
+    """Add the thumbnail URL, derived from image_url, to a listing we uploaded the image for."""
+    image_url = listing.get('image_url')
+    if image_url and f"/{IMAGE_BUCKET}/listings/" in image_url:
+        base, filename = image_url.split('?', 1)[0].rsplit('/', 1)
+        listing['thumbnail_url'] = f"{base}/thumbs/{filename.rsplit('.', 1)[0]}.webp"
+    return listing
+
+
+def make_thumbnail(local_path):
+    """Render a WebP thumbnail. Runs in the process pool."""
+    with Image.open(local_path) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        output = io.BytesIO()
+        image.save(output, format="WEBP", quality=80)
+        return output.getvalue()
+
+
+def upload_image(local_path, file_path, content_type):
+    """Stream the original image to storage. The spooled file is kept for the thumbnail."""
+    try:
+        with open(local_path, 'rb') as f:
+            supabase.storage.from_(IMAGE_BUCKET).upload(
+                path=file_path,
+                file=f,
+                file_options={"content-type": content_type}
+            )
+    except Exception:
+        os.remove(local_path)
+        raise
+
+
+def queue_thumbnail(local_path, file_path):
+    """Render the thumbnail, then upload it once the render is done."""
+    try:
+        render = variant_executor.submit(make_thumbnail, local_path)
+    except Exception as e:
+        print(f"Error creating thumbnail for {file_path}: {e}")
+        os.remove(local_path)
+        return
+    render.add_done_callback(
+        lambda done: thumbnail_executor.submit(upload_thumbnail, done, local_path, file_path)
+    )
+
+
+def upload_thumbnail(render, local_path, file_path):
+    try:
+        supabase.storage.from_(IMAGE_BUCKET).upload(
+            path=thumbnail_path(file_path),
+            file=render.result(),
+            file_options={"content-type": "image/webp"}
+        )
+    except Exception as e:
+        print(f"Error creating thumbnail for {file_path}: {e}")
+    finally:
+        os.remove(local_path)
+
+
+def discard_upload(upload, local_path, file_path):
+    """Drop an image whose listing was never created."""
+    if upload.cancel():
+        os.remove(local_path)
+        return
+
+    def remove(done):
+        # A failed upload has already removed its spooled file and left nothing in storage
+        if done.exception() is not None:
+            return
+        os.remove(local_path)
+        try:
+            supabase.storage.from_(IMAGE_BUCKET).remove([file_path])
+        except Exception as e:
+            print(f"Error removing orphaned image {file_path}: {e}")
+
+    upload.add_done_callback(remove)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def image_too_large(e):
+    return jsonify({"error": f"Image must be at most {MAX_IMAGE_BYTES // (1024 * 1024)} MB"}), 413
+
 
 # Create a new listing
 @app.route('/api/marketplace/listings', methods=['POST'])
@@ -202,43 +834,101 @@ def create_listing():
             return jsonify({"error": "Invalid seller_id format, must be UUID"}), 400
 
         # Handle image upload if present
+        upload = None
         if image_file and image_file.filename != '':
+            if not (image_file.mimetype or '').startswith('image/'):
+                return jsonify({"error": "Image must be an image file"}), 400
+
             # Generate a unique filename
             filename = f"{uuid.uuid4()}-{secure_filename(image_file.filename)}"
             file_path = f"listings/{filename}"
-            bucket_name = "marketplace-images"
 
-            # Read file content
-            file_content = image_file.read()
+            # Spool to disk in chunks; the upload then streams from the file
+            local_path = spool_image(image_file)
 
-            # Upload to Supabase storage
-            supabase.storage.from_(bucket_name).upload(
-                path=file_path,
-                file=file_content,
-                file_options={"content-type": image_file.content_type}
+            # Upload to Supabase storage while the row is inserted
+            upload = upload_executor.submit(
+                upload_image, local_path, file_path, image_file.mimetype
             )
 
-            # Get the public URL
-            image_url = supabase.storage.from_(bucket_name).get_public_url(file_path)
-
-            # Add the image URL to the listing data
-            listing_data['image_url'] = image_url
+            # The public URL is derived from the path, no need to wait for the upload
+            listing_data['image_url'] = supabase.storage.from_(IMAGE_BUCKET).get_public_url(file_path)
 
         # Insert the listing into Supabase
-        result = supabase.table('marketplace').insert(listing_data).execute()
+        try:
+            result = supabase.table('marketplace').insert(listing_data).execute()
+        except Exception:
+            if upload is not None:
+                discard_upload(upload, local_path, file_path)
+            raise
         new_listing_id = result.data[0]['id']
 
+        if upload is not None:
+            try:
+                upload.result()
+            except Exception:
+                # Don't leave a listing pointing at a missing image
+                supabase.table('marketplace').delete().eq('id', new_listing_id).execute()
+                raise
+            queue_thumbnail(local_path, file_path)
+
+        invalidate_listings()
+
         if listing_data.get('type') == 'auction':
             redis_client.set(new_listing_id, listing_data['price'])
+            schedule_auction_close(new_listing_id, listing_data['auction_end_date'])
 
-        return jsonify(result.data[0]), 201
+        return jsonify(with_thumbnail_url(result.data[0])), 201
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         import traceback
         print(traceback.format_exc())  # Print the full stack trace
         return jsonify({"error": str(e)}), 500
 
+# Listing query options
+LISTING_FIELDS = {
+    'id', 'seller_id', 'seller_name', 'card_id', 'title', 'description', 'price',
+    'type', 'status', 'grade', 'image_url', 'created_at', 'updated_at',
+    'auction_start_date', 'auction_end_date', 'highest_bid', 'highest_bidder_id',
+    'bid_count', 'reserve_price',
+}
+LISTING_ORDERS = {'price', 'auction_end_date', 'created_at'}
+DEFAULT_LISTING_LIMIT = 50
+MAX_LISTING_LIMIT = 200
+
+
+def encode_listing_cursor(row, order_column):
+    raw = json.dumps([row.get(order_column), row['id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_listing_cursor(cursor):
+    value, listing_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, str(uuid.UUID(listing_id))
+
+
+def after_listing_cursor(order_column, descending, value, listing_id):
+    """PostgREST `or` filter for rows that sort after (value, id), nulls last."""
+    op = 'lt' if descending else 'gt'
+    if value is None:
+        return f'and({order_column}.is.null,id.{op}.{listing_id})'
+    quoted = json.dumps(value) if isinstance(value, str) else value
+    return (
+        f'{order_column}.{op}.{quoted},'
+        f'and({order_column}.eq.{quoted},id.{op}.{listing_id}),'
+        f'{order_column}.is.null'
+    )
+
+
 # Get all listings
+# Query params:
+#   status, type, seller_id, card_id   equality filters
+#   min_price, max_price, title         price range and title prefix filters
+#   order                               price, auction_end_date or created_at, "-" prefix for descending
+#   fields                              comma separated columns to return
+#   limit, cursor                       keyset pagination, next cursor in X-Next-Cursor
 @app.route('/api/marketplace/listings', methods=['GET'])
 def get_listings():
     try:
@@ -247,28 +937,91 @@ def get_listings():
         type_filter = request.args.get('type')
         seller_id = request.args.get('seller_id')
         card_id = request.args.get('card_id')
+        min_price = request.args.get('min_price', type=float)
+        max_price = request.args.get('max_price', type=float)
+        title_prefix = request.args.get('title')
+
+        order = request.args.get('order', '-created_at')
+        descending = order.startswith('-')
+        order_column = order.lstrip('-')
+        if order_column not in LISTING_ORDERS:
+            return jsonify({"error": f"order must be one of {sorted(LISTING_ORDERS)}"}), 400
+
+        # Without limit or cursor the whole result is returned, as before paging
+        # existed; existing callers rely on that
+        paged = 'limit' in request.args or 'cursor' in request.args
+        limit = None
+        if paged:
+            try:
+                limit = int(request.args.get('limit', DEFAULT_LISTING_LIMIT))
+            except ValueError:
+                return jsonify({"error": "limit must be an integer"}), 400
+            limit = max(1, min(limit, MAX_LISTING_LIMIT))
+
+        # id and the order column are always returned, the cursor is built from them
+        columns = '*'
+        if request.args.get('fields'):
+            fields = set(request.args['fields'].split(','))
+            if not fields <= LISTING_FIELDS:
+                return jsonify({"error": f"Unknown fields: {sorted(fields - LISTING_FIELDS)}"}), 400
+            columns = ','.join(sorted(fields | {'id', order_column}))
+
+        cursor = None
+        if request.args.get('cursor'):
+            try:
+                cursor = decode_listing_cursor(request.args['cursor'])
+            except (ValueError, TypeError):
+                return jsonify({"error": "Invalid cursor"}), 400
+
+        # Serve from cache when this exact query was answered since the last write
+        signature = [status, type_filter, seller_id, card_id, min_price, max_price,
+                     title_prefix, order, limit, columns, cursor]
+        cache_key = listings_cache_key(signature)
+        page = cache_get(cache_key)
+
+        if page is None:
+            # Build the query
+            query = supabase.table('marketplace').select(columns, count='exact')
+
+            # Apply filters if provided
+            if status:
+                query = query.eq('status', status)
+            if type_filter:
+                query = query.eq('type', type_filter)
+            if seller_id:
+                query = query.eq('seller_id', seller_id)
+            if card_id:  # Add this condition to filter by card_id
+                query = query.eq('card_id', card_id)
+            if min_price is not None:
+                query = query.gte('price', min_price)
+            if max_price is not None:
+                query = query.lte('price', max_price)
+            if title_prefix:
+                escaped = title_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                query = query.ilike('title', f'{escaped}%')
+            if cursor:
+                query = query.or_(after_listing_cursor(order_column, descending, *cursor))
+
+            query = query.order(order_column, desc=descending, nullsfirst=False).order('id', desc=descending)
+            if limit is None:
+                result = query.execute()
+                page = {"rows": result.data, "count": result.count, "next": None}
+            else:
+                # One extra row tells us whether there is a next page
+                result = query.limit(limit + 1).execute()
+                rows = result.data[:limit]
+                page = {
+                    "rows": rows,
+                    "count": result.count,
+                    "next": encode_listing_cursor(rows[-1], order_column) if len(result.data) > limit else None,
+                }
+            cache_set(cache_key, page, LISTINGS_CACHE_TTL)
 
-        # Build the query
-        query = supabase.table('marketplace').select('*')
-
-        # Apply filters if provided
-        if status:
-            query = query.eq('status', status)
-        if type_filter:
-            query = query.eq('type', type_filter)
-        if seller_id:
-            query = query.eq('seller_id', seller_id)
-        if card_id:  # Add this condition to filter by card_id
-            query = query.eq('card_id', card_id)
-
-        # Execute the query
-        result = query.execute()
-
-        response = jsonify(result.data)
-        response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, proxy-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-        return response, 200
+        response = jsonify([with_thumbnail_url(row) for row in page["rows"]])
+        response.headers["X-Total-Count"] = str(page["count"])
+        if page["next"]:
+            response.headers["X-Next-Cursor"] = page["next"]
+        return conditional_response(response)
 
         #return jsonify(result.data), 200
 
@@ -285,19 +1038,54 @@ def get_listing(listing_id):
         except ValueError:
             return jsonify({"error": "Invalid listing ID format"}), 400
 
-        # Query the listing
-        result = supabase.table('marketplace').select('*').eq('id', listing_id).execute()
+        # Check the cache, then query the listing
+        listing = cache_get(listing_cache_key(listing_id))
+        if listing is None:
+            version = listing_version(listing_id)
+            result = supabase.table('marketplace').select('*').eq('id', listing_id).execute()
 
-        if not result.data:
-            return jsonify({"error": "Listing not found"}), 404
+            if not result.data:
+                return jsonify({"error": "Listing not found"}), 404
 
-        # Return the listing directly
-        return jsonify(result.data[0]), 200
+            listing = result.data[0]
+            cache_listing(listing, version)
+
+        # Return the listing directly, versioned by updated_at
+        return conditional_response(jsonify(with_thumbnail_url(listing)), etag=listing.get('updated_at'))
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Optimistic concurrency
+# Every write stamps updated_at, and GET /listings/<id> returns it as the ETag.
+# A client may send that ETag back in If-Match so its write only applies if
+# nobody changed the listing since it was read.
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def if_match_version():
+    # The ETag from GET /listings/<id> is the quoted updated_at; "*" matches any version
+    version = request.headers.get('If-Match')
+    if not version or version.strip() == '*':
+        return None
+    return version.strip().strip('"')
+
+
+def mutation_failure(listing_id, version):
+    """Work out why a conditional write matched no rows. Only runs on failure."""
+    check_result = supabase.table('marketplace').select('id, type, updated_at, highest_bid').eq('id', listing_id).execute()
+    if not check_result.data:
+        return None, (jsonify({"error": "Listing not found"}), 404)
+    if version is not None:
+        current = check_result.data[0]
+        if current.get('updated_at') != version:
+            return current, (jsonify({"error": "Listing was modified", "updated_at": current.get('updated_at')}), 412)
+    return check_result.data[0], None
+
+
 # Update a listing
+# Send If-Match: <updated_at> to only update the listing as it was read.
 @app.route('/api/marketplace/listings/<listing_id>', methods=['PUT'])
 def update_listing(listing_id):
     try:
@@ -309,19 +1097,6 @@ def update_listing(listing_id):
         except ValueError:
             return jsonify({"error": "Invalid listing ID format"}), 400
 
-        # Check if listing exists
-        check_result = supabase.table('marketplace').select('id, type').eq('id', listing_id).execute()
-
-        if not check_result.data:
-            return jsonify({"error": "Listing not found"}), 404
-
-        # Additional validation for auction type
-        if data.get('type') == 'auction':
-            if 'auction_start_date' not in data and 'auction_end_date' not in data:
-                current_type = check_result.data[0].get('type')
-                if current_type != 'auction':
-                    return jsonify({"error": "Auction listings require start and end dates"}), 400
-
         # Validate seller_id is a valid UUID if provided
         try:
             if 'seller_id' in data:
@@ -331,8 +1106,55 @@ def update_listing(listing_id):
         except ValueError:
             return jsonify({"error": "Invalid UUID format for seller_id or highest_bidder_id"}), 400
 
-        # Update the listing
-        result = supabase.table('marketplace').update(data).eq('id', listing_id).execute()
+        highest_bid = None
+        if data.get('highest_bid') is not None:
+            try:
+                highest_bid = float(data['highest_bid'])
+            except (TypeError, ValueError):
+                return jsonify({"error": "highest_bid must be a number"}), 400
+
+        version = if_match_version()
+        data['updated_at'] = now_iso()
+
+        # Update the listing; the returned rows tell us whether it matched
+        query = supabase.table('marketplace').update(data).eq('id', listing_id)
+        if version is not None:
+            query = query.eq('updated_at', version)
+        if highest_bid is not None:
+            # Never lower a highest bid another writer has already recorded.
+            # Equal is allowed: the bid flush usually stores the amount first,
+            # and the bidder's own update still has to record who placed it.
+            query = query.or_(f'highest_bid.is.null,highest_bid.lte.{highest_bid}')
+
+        # Additional validation for auction type: without dates, only an
+        # existing auction may be updated as an auction
+        needs_auction = (data.get('type') == 'auction'
+                         and 'auction_start_date' not in data and 'auction_end_date' not in data)
+        if needs_auction:
+            query = query.eq('type', 'auction')
+
+        result = query.execute()
+
+        if not result.data:
+            current, error = mutation_failure(listing_id, version)
+            if error:
+                return error
+            if needs_auction and current.get('type') != 'auction':
+                return jsonify({"error": "Auction listings require start and end dates"}), 400
+            if highest_bid is not None and (current.get('highest_bid') or 0) > highest_bid:
+                return jsonify({"error": "A higher bid is already recorded",
+                                "highest_bid": current.get('highest_bid')}), 409
+            return jsonify({"error": "Listing not updated"}), 409
+
+        invalidate_listings(listing_id)
+
+        # Keep the close timer in step with the listing
+        updated = result.data[0]
+        if updated.get('type') == 'auction' and updated.get('status') == 'active' and updated.get('auction_end_date'):
+            if 'auction_end_date' in data or 'status' in data or 'type' in data:
+                schedule_auction_close(listing_id, updated['auction_end_date'])
+        elif 'status' in data or 'type' in data:
+            unschedule_auction_close(listing_id)
 
         return jsonify(result.data[0]), 200
 
@@ -340,6 +1162,7 @@ def update_listing(listing_id):
         return jsonify({"error": str(e)}), 500
 
 # Delete a listing
+# Send If-Match: <updated_at> to only delete the listing as it was read.
 @app.route('/api/marketplace/listings/<listing_id>', methods=['DELETE'])
 def delete_listing(listing_id):
     try:
@@ -349,21 +1172,41 @@ def delete_listing(listing_id):
         except ValueError:
             return jsonify({"error": "Invalid listing ID format"}), 400
 
-        # Check if listing exists
-        check_result = supabase.table('marketplace').select('id').eq('id', listing_id).execute()
+        # Delete the listing; the returned rows tell us whether it existed
+        version = if_match_version()
+        query = supabase.table('marketplace').delete().eq('id', listing_id)
+        if version is not None:
+            query = query.eq('updated_at', version)
+        result = query.execute()
 
-        if not check_result.data:
-            return jsonify({"error": "Listing not found"}), 404
+        if not result.data:
+            _, error = mutation_failure(listing_id, version)
+            return error or (jsonify({"error": "Listing not found"}), 404)
 
-        # Delete the listing
-        result = supabase.table('marketplace').delete().eq('id', listing_id).execute()
+        invalidate_listings(listing_id)
+        unschedule_auction_close(listing_id)
 
         return jsonify({"message": "Listing deleted successfully"}), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Batch lookups
+# IDs are split into chunks so the PostgREST `in` filter stays well under URL
+# limits, and the chunks are fetched concurrently.
+BATCH_MAX_IDS = 1000
+BATCH_CHUNK_SIZE = 100
+batch_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def fetch_listings_chunk(listing_ids):
+    return supabase.table('marketplace').select('*').in_('id', listing_ids).execute().data
+
+
 # Get multiple listings by passing an array of IDs
+# Body: {"listing_ids": [...], "include_missing": false}
+# Returns the listings in request order (duplicates removed). With
+# include_missing, returns {"listings": [...], "not_found": [...]} instead.
 @app.route('/api/marketplace/listings/batch', methods=['POST'])
 def get_listings_batch():
     try:
@@ -374,24 +1217,52 @@ def get_listings_batch():
         if not listing_ids or not isinstance(listing_ids, list):
             return jsonify({"error": "A list of listing_ids is required"}), 400
 
-        # Validate each ID is a valid UUID
+        # Normalize and deduplicate, reporting every invalid ID at once
+        ordered_ids = {}
+        invalid = []
         for listing_id in listing_ids:
             try:
-                uuid_obj = uuid.UUID(listing_id)
+                ordered_ids.setdefault(str(uuid.UUID(str(listing_id))), None)
             except ValueError:
-                return jsonify({"error": f"Invalid listing ID format: {listing_id}"}), 400
-
-        # Query the listings - Supabase doesn't have a direct "in" filter,
-        # so we'll use a more complex approach with "or" filters
-        if not listing_ids:
-            return jsonify([]), 200
-
-        query = supabase.table('marketplace').select('*').in_('id', listing_ids)
-
-        # Execute the query
-        result = query.execute()
-
-        return jsonify(result.data), 200
+                invalid.append(listing_id)
+        if invalid:
+            return jsonify({"error": "Invalid listing ID format", "invalid_ids": invalid}), 400
+        ids = list(ordered_ids)
+        if len(ids) > BATCH_MAX_IDS:
+            return jsonify({"error": f"At most {BATCH_MAX_IDS} listing_ids per request"}), 400
+
+        # Serve what we can from the per-listing cache, query only the misses
+        # Versions are read with the cache, before the misses are queried
+        found = {}
+        versions = {}
+        try:
+            values = redis_client.mget(
+                [listing_cache_key(listing_id) for listing_id in ids]
+                + [listing_version_key(listing_id) for listing_id in ids]
+            )
+            for listing_id, listing, version in zip(ids, values[:len(ids)], values[len(ids):]):
+                if listing is not None:
+                    found[listing_id] = json.loads(listing)
+                versions[listing_id] = version or ""
+        except redis.RedisError as e:
+            print(f"Error reading listing cache: {e}")
+
+        missing = [listing_id for listing_id in ids if listing_id not in found]
+        chunks = [missing[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(missing), BATCH_CHUNK_SIZE)]
+        for rows in batch_executor.map(fetch_listings_chunk, chunks):
+            for listing in rows:
+                found[listing['id']] = listing
+                cache_listing(listing, versions.get(listing['id']))
+
+        listings = [with_thumbnail_url(found[listing_id]) for listing_id in ids if listing_id in found]
+        not_found = [listing_id for listing_id in ids if listing_id not in found]
+
+        if data.get('include_missing'):
+            return jsonify({"listings": listings, "not_found": not_found}), 200
+
+        response = jsonify(listings)
+        response.headers["X-Not-Found-Count"] = str(len(not_found))
+        return response, 200
 
     except Exception as e:
         import traceback
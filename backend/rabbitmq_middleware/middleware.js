@@ -11,25 +11,59 @@ const ROUTING_KEY = '*.notify';
 // 🔗 Replace this with your actual OutSystems API endpoint
 const OUTSYSTEMS_API = 'https://personal-gvra7qzz.outsystemscloud.com/Notification/rest/NotificationAPI/api/notification/receive';
 
+// Retry tiers in seconds; keep in sync with retry_delays in amqp_setup.py
+const RETRY_DELAYS = [5, 30, 300];
+
+// Moves a failed message to the next delay queue, which hands it back to
+// QUEUE_NAME once its TTL expires. After the last tier it is nacked, and the
+// queue's dead-letter exchange parks it in notification.dead.
+function retryOrDeadLetter(channel, msg) {
+  const headers = { ...(msg.properties.headers || {}) };
+  const attempt = headers['x-retry-count'] || 0;
+
+  if (attempt >= RETRY_DELAYS.length) {
+    channel.nack(msg, false, false);
+    return;
+  }
+
+  headers['x-retry-count'] = attempt + 1;
+  headers['x-original-routing-key'] = headers['x-original-routing-key'] || msg.fields.routingKey;
+  channel.sendToQueue(`${QUEUE_NAME}.retry.${RETRY_DELAYS[attempt]}s`, msg.content, {
+    headers,
+    contentType: msg.properties.contentType,
+    persistent: true,
+  });
+  channel.ack(msg);
+  console.log(`🔁 Retrying in ${RETRY_DELAYS[attempt]}s (attempt ${attempt + 1})`);
+}
+
 async function connectWithRetry(attempt = 1) {
+  let conn;
   try {
     console.log(`🔁 Trying AMQP connection (attempt ${attempt})...`);
-    const conn = await amqp.connect(RABBITMQ_URL);
+    conn = await amqp.connect(RABBITMQ_URL);
     const channel = await conn.createChannel();
 
-    // Assert exchange and queue
-    await channel.assertExchange(EXCHANGE_NAME, 'topic', { durable: true });
-    await channel.assertQueue(QUEUE_NAME, { durable: true });
-
-    // Bind to only *.inform
-    await channel.bindQueue(QUEUE_NAME, EXCHANGE_NAME, ROUTING_KEY);
+    // The queue, its bindings and its retry/dead-letter queues are created by
+    // amqp_setup.py. Only check they exist: asserting here with other
+    // arguments would fail with PRECONDITION_FAILED.
+    await channel.checkExchange(EXCHANGE_NAME);
+    await channel.checkQueue(QUEUE_NAME);
 
     console.log(`✅ Connected. Listening to ${QUEUE_NAME} with routing key "${ROUTING_KEY}"`);
 
     // Start consuming
     channel.consume(QUEUE_NAME, async (msg) => {
       if (msg !== null) {
-        const data = JSON.parse(msg.content.toString());
+        let data;
+        try {
+          data = JSON.parse(msg.content.toString());
+        } catch (err) {
+          // Retrying will not fix a malformed message, dead-letter it right away
+          console.error("❌ Malformed message, dead-lettering:", err.message);
+          channel.nack(msg, false, false);
+          return;
+        }
         console.log("📨 Incoming Message:", data);
 
         try {
@@ -40,12 +74,13 @@ async function connectWithRetry(attempt = 1) {
           channel.ack(msg);
         } catch (err) {
           console.error("❌ Failed to forward:", err.response?.data || err.message);
-          channel.nack(msg, false, false); // Drop the message (or set to true to requeue)
+          retryOrDeadLetter(channel, msg);
         }
       }
     });
   } catch (err) {
     console.error(`❌ AMQP connection failed (attempt ${attempt}):`, err.message);
+    if (conn) conn.close().catch(() => {}); // e.g. the queue is not set up yet
     setTimeout(() => connectWithRetry(attempt + 1), 5000);
   }
 }
@@ -2,129 +2,280 @@
 
 """
 A standalone script to create exchanges and queues on RabbitMQ.
+
+The topology is described as data (exchanges, queues, bindings, policies)
+and reconciled against the broker: exchanges and queues are checked with
+passive declares, bindings and policies against the management API, and
+only what is missing gets created, all over a single connection. Running
+it again against a set-up broker changes nothing.
+
+Every work queue gets:
+- its own dead-letter exchange <queue>.dlx, feeding a lazy <queue>.dead queue
+  where messages that exhausted their retries (or were rejected) are parked
+- tiered delay queues <queue>.retry.<n>s; consumers republish a failed message
+  to the next tier, and when its TTL expires the broker moves it back onto
+  the work queue
+- a length limit, so a stuck consumer pushes back on publishers instead of
+  filling the broker's disk
 """
 
+import base64
+import json
+import time
+import urllib.parse
+import urllib.request
 import pika
 
 # RabbitMQ connection details
 amqp_host = "rabbitmq"  # Use "rabbitmq" if running inside Docker
 amqp_port = 5672
+amqp_management_port = 15672
 amqp_user = "guest"     # Default RabbitMQ username
 amqp_password = "guest" # Default RabbitMQ password
+amqp_vhost = "/"
 
 exchange_name = "grading_topic"
 exchange_type = "topic"
 
-# Creates the exchange
-def create_exchange(hostname, port, username, password, exchange_name, exchange_type):
-    print(f"Connecting to AMQP broker {hostname}:{port}...")
-    
-    # Create credentials and connection parameters
-    credentials = pika.PlainCredentials(username, password)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            host=hostname,
-            port=port,
-            credentials=credentials,
-            heartbeat=300,
-            blocked_connection_timeout=300,
-        )
-    )
-    print("Connected")
+# Work queues and their binding keys on grading_topic
+work_queues = {
+    "external_grading": ["*.externalGrading"],
+    "grading": ["*.grading", "*.update"],
+    "delivery": ["*.delivery"],
+    "notification": ["*.notify"],
+}
 
-    print("Open channel")
-    channel = connection.channel()
+# Retry tiers in seconds; keep in sync with RETRY_DELAYS in amqp_lib.py
+# and the notification middleware
+retry_delays = (5, 30, 300)
 
-    # Set up the exchange if it doesn't exist
-    print(f"Declare exchange: {exchange_name}")
-    channel.exchange_declare(
-        exchange=exchange_name, exchange_type=exchange_type, durable=True
-    )
-    # 'durable' makes the exchange survive broker restarts
+work_queue_max_length = 100000
+# Redeliveries (e.g. consumer crashes) before the broker dead-letters a message
+work_queue_delivery_limit = 10
+
+# Queues read by browsers over Web STOMP. STOMP clients declare these queues
+# themselves without arguments, so their limits are applied as a policy
+# instead; nobody may be listening, so old updates are dropped first.
+stomp_queues = {
+    "auction": ["*.auction"],
+    "return": ["*.return"],
+}
+stomp_queue_policy = {
+    "max-length": 10000,
+    "overflow": "drop-head",
+    "queue-mode": "lazy",
+}
+
+
+###############################################################################################
+
+# Topology spec
+
+def build_topology():
+    exchanges = {exchange_name: exchange_type}
+    queues = {}
+    bindings = set()
+
+    for queue_name, routing_keys in work_queues.items():
+        # Quorum queues are replicated and dead-letter nacked messages; once
+        # full, new publishes are rejected (and nacked to confirming publishers)
+        queues[queue_name] = {
+            "x-queue-type": "quorum",
+            "x-dead-letter-exchange": f"{queue_name}.dlx",
+            "x-max-length": work_queue_max_length,
+            "x-overflow": "reject-publish",
+            "x-delivery-limit": work_queue_delivery_limit,
+        }
+        for routing_key in routing_keys:
+            bindings.add((exchange_name, queue_name, routing_key))
 
-    return channel
+        # Lazy: parked messages may pile up, keep them on disk rather than in memory
+        exchanges[f"{queue_name}.dlx"] = "fanout"
+        queues[f"{queue_name}.dead"] = {"x-queue-mode": "lazy"}
+        bindings.add((f"{queue_name}.dlx", f"{queue_name}.dead", "#"))
 
-# Creates the individual queues attached to the exchange
-def create_queue(channel, exchange_name, queue_name, routing_key):
-    print(f"Bind to queue: {queue_name}")
-    channel.queue_declare(queue=queue_name, durable=True)
-    # 'durable' makes the queue survive broker restarts
+        # Delay queues are published to through the default exchange and,
+        # once the TTL expires, dead-letter straight back onto the work queue
+        for delay in retry_delays:
+            queues[f"{queue_name}.retry.{delay}s"] = {
+                "x-message-ttl": delay * 1000,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue_name,
+            }
 
-    # Bind the queue to the exchange via the routing key
-    channel.queue_bind(
-        exchange=exchange_name, queue=queue_name, routing_key=routing_key
+    for queue_name, routing_keys in stomp_queues.items():
+        queues[queue_name] = {}
+        for routing_key in routing_keys:
+            bindings.add((exchange_name, queue_name, routing_key))
+
+    policies = {
+        "stomp-queues": {
+            "pattern": f"^({'|'.join(stomp_queues)})$",
+            "definition": stomp_queue_policy,
+            "apply-to": "queues",
+        },
+    }
+
+    return {"exchanges": exchanges, "queues": queues, "bindings": bindings, "policies": policies}
+
+
+###############################################################################################
+
+# Management API, used for what passive declares cannot report:
+# queue arguments, existing bindings and policies
+
+def management_request(path, method="GET", body=None):
+    url = f"http://{amqp_host}:{amqp_management_port}/api/{path}"
+    token = base64.b64encode(f"{amqp_user}:{amqp_password}".encode()).decode()
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode() if body is not None else None,
+        method=method,
+        headers={"Authorization": f"Basic {token}", "Content-Type": "application/json"},
     )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        payload = response.read()
+    return json.loads(payload) if payload else None
 
-# Main execution
-try:
-    # Create the exchange
-    channel = create_exchange(
-        hostname=amqp_host,
+def load_definitions():
+    # One request returns the vhost's queues, bindings and policies
+    try:
+        return management_request(f"definitions/{urllib.parse.quote(amqp_vhost, safe='')}")
+    except OSError as exception:
+        print(f"Management API unavailable, only checking existence: {exception=}")
+        return None
+
+
+###############################################################################################
+
+# Reconciliation
+
+def connect(max_retries=30):
+    credentials = pika.PlainCredentials(amqp_user, amqp_password)
+    parameters = pika.ConnectionParameters(
+        host=amqp_host,
         port=amqp_port,
-        username=amqp_user,
-        password=amqp_password,
-        exchange_name=exchange_name,
-        exchange_type=exchange_type,
+        virtual_host=amqp_vhost,
+        credentials=credentials,
+        heartbeat=300,
+        blocked_connection_timeout=300,
     )
+    for attempt in range(max_retries):
+        try:
+            print(f"Connecting to AMQP broker {amqp_host}:{amqp_port}...")
+            connection = pika.BlockingConnection(parameters)
+            print("Connected")
+            return connection
+        except pika.exceptions.AMQPConnectionError as exception:
+            delay = min(5, 0.5 * 2 ** attempt)
+            print(f"Failed to connect: {exception=}")
+            print(f"Retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+    raise Exception(f"Max {max_retries} retries exceeded...")
 
-    # Create external_grading queue
-    create_queue(
-        channel=channel,
-        exchange_name=exchange_name,
-        queue_name="external_grading",
-        routing_key="*.externalGrading",
-    )
+def normalize(arguments):
+    # Classic is the default queue type, whether or not it is spelled out
+    return {key: value for key, value in arguments.items() if (key, value) != ("x-queue-type", "classic")}
 
-    # Create grading queue
-    create_queue(
-        channel=channel,
-        exchange_name=exchange_name,
-        queue_name="grading",
-        routing_key="*.grading",
-    )
+class Reconciler:
+    """Applies the difference between the topology spec and the broker."""
 
-    # Add .update binding key to grading queue
-    create_queue(
-        channel=channel,
-        exchange_name=exchange_name,
-        queue_name="grading",
-        routing_key="*.update",
-    )
-    
-    # Create delivery queue
-    create_queue(
-        channel=channel,
-        exchange_name=exchange_name,
-        queue_name="delivery",
-        routing_key="*.delivery",
-    )
-    
-    # Create notification queue
-    create_queue(
-        channel=channel,
-        exchange_name=exchange_name,
-        queue_name="notification",
-        routing_key="*.notify",
-    )
+    def __init__(self, connection, definitions):
+        self.connection = connection
+        self.channel = connection.channel()
+        self.definitions = definitions
+        self.changes = 0
+        self.drift = 0
 
-    # Create auction queue
-    create_queue(
-        channel=channel,
-        exchange_name=exchange_name,
-        queue_name="auction",
-        routing_key="*.auction",
-    )
-    
-    # Create return queue
-    create_queue(
-        channel=channel,
-        exchange_name=exchange_name,
-        queue_name="return",
-        routing_key="*.return",
-    )
+    def exists(self, declare, **kwargs):
+        # A passive declare of something missing closes the channel with
+        # 404; open a new one on the same connection and carry on
+        try:
+            declare(passive=True, **kwargs)
+            return True
+        except pika.exceptions.ChannelClosedByBroker as exception:
+            if exception.reply_code != 404:
+                raise
+            self.channel = self.connection.channel()
+            return False
+
+    def exchange(self, name, kind):
+        if self.exists(self.channel.exchange_declare, exchange=name):
+            return
+        print(f"Declare exchange: {name} ({kind})")
+        self.channel.exchange_declare(exchange=name, exchange_type=kind, durable=True)
+        self.changes += 1
+
+    def queue(self, name, arguments, actual_arguments):
+        if self.exists(self.channel.queue_declare, queue=name):
+            # Arguments cannot be changed in place, so drift is only reported
+            if actual_arguments is not None and normalize(actual_arguments.get(name, {})) != normalize(arguments):
+                print(f"Queue {name} has arguments {actual_arguments.get(name)}, expected {arguments}")
+                print(f"Delete queue {name} (or run docker compose down -v) to apply them")
+                self.drift += 1
+            return
+        print(f"Declare queue: {name}")
+        self.channel.queue_declare(queue=name, durable=True, arguments=arguments or None)
+        self.changes += 1
+
+    def binding(self, exchange, queue, routing_key):
+        print(f"Bind {queue} to {exchange} with {routing_key}")
+        self.channel.queue_bind(exchange=exchange, queue=queue, routing_key=routing_key)
+        self.changes += 1
+
+    def policy(self, name, policy):
+        print(f"Set policy: {name}")
+        try:
+            vhost = urllib.parse.quote(amqp_vhost, safe="")
+            management_request(f"policies/{vhost}/{name}", method="PUT", body=policy)
+            self.changes += 1
+        except OSError as exception:
+            print(f"Unable to set policy {name}: {exception=}")
+
+    def apply(self, topology):
+        definitions = self.definitions
+        actual_arguments = None
+        actual_bindings = set()
+        actual_policies = {}
+        if definitions is not None:
+            actual_arguments = {
+                queue["name"]: queue.get("arguments", {}) for queue in definitions.get("queues", [])
+            }
+            actual_bindings = {
+                (binding["source"], binding["destination"], binding["routing_key"])
+                for binding in definitions.get("bindings", [])
+                if binding.get("destination_type") == "queue"
+            }
+            actual_policies = {policy["name"]: policy for policy in definitions.get("policies", [])}
+
+        for name, kind in topology["exchanges"].items():
+            self.exchange(name, kind)
+
+        for name, arguments in topology["queues"].items():
+            self.queue(name, arguments, actual_arguments)
+
+        # Rebinding is harmless, but skipped when the broker already has it
+        for exchange, queue, routing_key in sorted(topology["bindings"] - actual_bindings):
+            self.binding(exchange, queue, routing_key)
+
+        for name, policy in topology["policies"].items():
+            actual = actual_policies.get(name, {})
+            if definitions is not None and all(actual.get(key) == value for key, value in policy.items()):
+                continue
+            self.policy(name, policy)
+
+
+# Main execution
+if __name__ == "__main__":
+    started = time.monotonic()
+    connection = connect()
+    try:
+        reconciler = Reconciler(connection, load_definitions())
+        reconciler.apply(build_topology())
+    finally:
+        if connection.is_open:
+            connection.close()
+            print("Connection closed")
 
-finally:
-    # Close the connection
-    if 'channel' in locals() and channel.is_open:
-        channel.close()
-        print("Connection closed")
\ No newline at end of file
+    elapsed = time.monotonic() - started
+    print(f"Topology up to date: {reconciler.changes} changes, {reconciler.drift} drifted queues, {elapsed:.2f}s")
@@ -4,17 +4,21 @@ import type { Card } from "~/types/card";
 
 export function useCards() {
     const cards = ref<Card[]>([]);
+    const total = ref(0);
     const card = ref<Card | null>(null);
     const isLoading = ref(true);
     const cardLoading = ref(false);
     const error = ref<string | null>(null);
     const cardError = ref<string | null>(null);
 
-    const fetchCards = async () => {
+    // Without page/limit the whole catalog is returned
+    const fetchCards = async (page?: number, limit?: number) => {
         try {
             isLoading.value = true;
-            const response = await axios.get("http://127.0.0.1:8000/inventory/inventory");
+            const params = page !== undefined || limit !== undefined ? { page, limit } : {};
+            const response = await axios.get("http://127.0.0.1:8000/inventory/inventory", { params });
             cards.value = response.data;
+            total.value = Number(response.headers["x-total-count"] ?? response.data.length);
         } catch (err: any) {
             error.value = err.message || "Failed to fetch cards";
             console.error(error.value);
@@ -47,6 +51,7 @@ export function useCards() {
     return {
        // All cards
        cards,
+       total,
        isLoading,
        error,
        fetchCards,
@@ -3,6 +3,7 @@ import { Client } from "@stomp/stompjs";
 class WebSocketService {
     constructor() {
         this.client = null;
+        this.pendingReplies = new Map(); // correlation-id -> callback
     }
 
     connect(url) {
@@ -38,6 +39,8 @@ class WebSocketService {
                 console.log("Connected to RabbitMQ WebSocket!");
                 this.subscribeToQueue(queue, onMessageReceived);
             },
+            // Replies sent to /temp-queue/ arrive without a subscription of ours
+            onUnhandledMessage: (message) => this.handleReply(message),
             onStompError: (frame) => {
                 console.error("Broker error: ", frame.headers["message"]);
             },
@@ -116,6 +119,32 @@ class WebSocketService {
         }
     }
 
+    // RPC: the reply comes back on a private temp queue, matched by correlation-id
+    request(exchange, routingKey, message, onReply) {
+        if (this.client && this.client.connected) {
+            const correlationId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+            this.pendingReplies.set(correlationId, onReply);
+            this.client.publish({
+                destination: `/exchange/${exchange}/${routingKey}`,
+                headers: {
+                    "reply-to": "/temp-queue/rpc",
+                    "correlation-id": correlationId,
+                    "content-type": "application/json",
+                },
+                body: JSON.stringify(message),
+            });
+        }
+    }
+
+    handleReply(message) {
+        const correlationId = message.headers["correlation-id"];
+        const onReply = this.pendingReplies.get(correlationId);
+        if (onReply && message.body) {
+            this.pendingReplies.delete(correlationId);
+            onReply(JSON.parse(message.body));
+        }
+    }
+
     // sendMessage(queue, message) {
     //     if (this.client && this.client.connected) {
     //         this.client.publish({
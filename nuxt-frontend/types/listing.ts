@@ -9,6 +9,7 @@ export interface Listing {
     status: "active" | "sold" | "cancelled";
     grade: number;
     image_url: string;
+    thumbnail_url?: string;
     created_at: string;
     updated_at: string;
     seller_name: string;